@@ -158,6 +158,7 @@ class PluginBrowser:
                 logger.debug(f"Plugin {plugin_display} was stopped")
                 del self.plugins[name]
                 logger.debug(f"Plugin {plugin_display} was removed from the dictionary")
+                self.loader.ws.remove_coalesced_events(f"loader/plugin_event/{name}/")
                 self.cleanup_plugin_settings(name)
             logger.debug("removing files %s" % str(name))
             rmtree(plugin_dir)
@@ -292,6 +293,9 @@ class PluginBrowser:
                     self.settings.setSetting("pluginOrder", current_plugin_order)
                     logger.debug("Plugin %s was added to the pluginOrder setting", name)
                 await self.loader.import_plugin(path.join(plugin_dir, "main.py"), plugin_folder)
+                if name in self.loader.plugins:
+                    # so the first load after the install already gets compressed bundles
+                    await self.loader.precompress_plugin(self.loader.plugins[name])
             elif not chown_ret:
                 logger.error("Could not chown plugin")
                 return
@@ -0,0 +1,293 @@
+from asyncio import Task, create_task, to_thread
+from collections import OrderedDict
+from gzip import compress
+from hashlib import blake2b
+from mimetypes import guess_type
+from os import chmod, fdopen, path, remove, replace, scandir, stat, utime, walk
+from tempfile import mkstemp
+from time import time
+from typing import Any, Awaitable, Callable, Dict, List, Tuple
+
+from aiohttp import web
+from aiohttp.helpers import ETag
+
+from .helpers import mkdir_as_user
+
+# Optional, aiohttp's speedups extra installs it
+try:
+    import brotli # pyright: ignore [reportMissingImports, reportMissingTypeStubs]
+except ImportError:
+    brotli = None
+
+# for URLs carrying the hash of what they point to, a changed file gets a new URL
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+# everything else has to be revalidated against its ETag before it is used
+REVALIDATE_CACHE_CONTROL = "no-cache"
+
+CHUNK_SIZE = 2 ** 16
+# total size of the bundles kept in memory, the least recently used ones are dropped first
+BUNDLE_CACHE_SIZE = 32 * 2 ** 20
+# only text assets of at least this size get compressed variants
+COMPRESSIBLE_EXTENSIONS = (".js", ".mjs", ".cjs", ".css", ".json", ".html", ".svg", ".map", ".txt")
+MIN_COMPRESS_SIZE = 1024
+# compressed variants that haven't been built or served for this many seconds are pruned
+COMPRESSED_VARIANT_MAX_AGE = 30 * 24 * 60 * 60
+
+def hash_file(file: str) -> str:
+    digest = blake2b(digest_size=8)
+    with open(file, "rb") as f:
+        while chunk := f.read(CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def hash_directory(directory: str) -> Dict[str, str]:
+    '''Returns the content hash of every file below directory, keyed by its path relative to it.'''
+    hashes: Dict[str, str] = {}
+    for root, _, files in walk(directory):
+        for file in files:
+            full_path = path.join(root, file)
+            hashes[path.relpath(full_path, directory).replace(path.sep, "/")] = hash_file(full_path)
+    return hashes
+
+def combine_hashes(hashes: Dict[str, str]) -> str | None:
+    '''Single hash that changes whenever any of the files changes, None if there are no files.'''
+    if not hashes:
+        return None
+    digest = blake2b(digest_size=8)
+    for name in sorted(hashes):
+        digest.update(f"{name}:{hashes[name]}\n".encode())
+    return digest.hexdigest()
+
+class FileHashCache:
+    '''
+    Content hashes of files that can change while the loader runs, a file is hashed again once its mtime or size changed.
+    '''
+    def __init__(self) -> None:
+        self.hashes: Dict[str, Tuple[int, int, str]] = {}
+
+    def _get(self, file: str) -> str | None:
+        try:
+            st = stat(file)
+            cached = self.hashes.get(file)
+            if cached and cached[0] == st.st_mtime_ns and cached[1] == st.st_size:
+                return cached[2]
+            file_hash = hash_file(file)
+        except OSError:
+            return None
+        self.hashes[file] = (st.st_mtime_ns, st.st_size, file_hash)
+        return file_hash
+
+    async def get(self, file: str) -> str | None:
+        return await to_thread(self._get, file)
+
+def _read(file: str) -> bytes:
+    with open(file, "rb") as f:
+        return f.read()
+
+def _read_with_mtime(file: str) -> Tuple[int, bytes]:
+    with open(file, "rb") as f:
+        return stat(f.fileno()).st_mtime_ns, f.read()
+
+class BundleCache:
+    '''
+    Plugin bundles (and their compressed variants) kept in memory as bytes, keyed by path and mtime.
+    '''
+    def __init__(self, max_size: int = BUNDLE_CACHE_SIZE) -> None:
+        self.max_size = max_size
+        self.size = 0
+        self.bundles: OrderedDict[str, Tuple[int, bytes]] = OrderedDict()
+
+    async def get(self, file: str) -> bytes:
+        cached = self.bundles.get(file)
+        if cached and cached[0] == stat(file).st_mtime_ns:
+            self.bundles.move_to_end(file)
+            return cached[1]
+
+        mtime, body = await to_thread(_read_with_mtime, file)
+        self._drop(file)
+        self.bundles[file] = (mtime, body)
+        self.size += len(body)
+        while self.size > self.max_size and len(self.bundles) > 1:
+            _, (_, dropped) = self.bundles.popitem(last=False)
+            self.size -= len(dropped)
+        return body
+
+    def _drop(self, file: str):
+        cached = self.bundles.pop(file, None)
+        if cached:
+            self.size -= len(cached[1])
+
+    def invalidate(self, directory: str):
+        '''Drops every cached file below directory.'''
+        prefix = path.join(directory, "")
+        for file in [file for file in self.bundles if file.startswith(prefix)]:
+            self._drop(file)
+
+def accepted_encodings(accept_encoding: str) -> List[str]:
+    encodings: List[str] = []
+    for part in accept_encoding.split(","):
+        encoding, _, params = part.strip().partition(";")
+        if params.strip().replace(" ", "") in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+            continue
+        encodings.append(encoding.strip().lower())
+    return encodings
+
+class CompressedVariants:
+    '''
+    Gzip and brotli variants of text assets, stored in directory under the content hash of the original.
+    A changed file has a new hash, so it can never be served a stale variant.
+    '''
+    def __init__(self, directory: str) -> None:
+        self.directory = directory
+        # preferred encoding first
+        self.encodings: Dict[str, Tuple[str, Callable[[bytes], bytes]]] = {}
+        if brotli:
+            self.encodings["br"] = ("br", brotli.compress) # pyright: ignore [reportUnknownMemberType]
+        self.encodings["gzip"] = ("gz", lambda data: compress(data, 9))
+        # variants being built for requests, keyed by the hash of the original
+        self.building: Dict[str, Task[None]] = {}
+
+    def is_compressible(self, file: str) -> bool:
+        return file.endswith(COMPRESSIBLE_EXTENSIONS)
+
+    def variant_path(self, file_hash: str, encoding: str) -> str:
+        return path.join(self.directory, f"{file_hash}.{self.encodings[encoding][0]}")
+
+    def build(self, file: str, file_hash: str):
+        '''Writes the missing variants of file, blocks on the compression.'''
+        if not self.is_compressible(file):
+            return
+        missing = [encoding for encoding in self.encodings if not path.exists(self.variant_path(file_hash, encoding))]
+        if not missing:
+            return
+        data = _read(file)
+        if len(data) < MIN_COMPRESS_SIZE:
+            return
+        if not path.isdir(self.directory):
+            # the loader runs as root, the cache belongs to the user like the rest of the homebrew folder
+            mkdir_as_user(path.dirname(self.directory))
+            mkdir_as_user(self.directory)
+        for encoding in missing:
+            variant = self.variant_path(file_hash, encoding)
+            # written under a temporary name first, a request never sees a partial variant. the name is unique,
+            # builds of the same variant (precompressing at install racing a request) can't write to each other's file
+            fd, temporary = mkstemp(dir=self.directory, prefix=f"{file_hash}.", suffix=".tmp")
+            try:
+                with fdopen(fd, "wb") as f:
+                    f.write(self.encodings[encoding][1](data))
+                chmod(temporary, 0o644)
+                replace(temporary, variant)
+            except:
+                remove(temporary)
+                raise
+
+    def build_directory(self, directory: str, hashes: Dict[str, str]):
+        '''Builds the variants of every file in hashes, as returned by hash_directory for directory.'''
+        for name, file_hash in hashes.items():
+            self.build(path.join(directory, name), file_hash)
+
+    def _build_in_background(self, file: str, file_hash: str):
+        if file_hash in self.building:
+            return
+        task = create_task(to_thread(self.build, file, file_hash))
+        self.building[file_hash] = task
+
+        def on_built(task: Task[None]):
+            self.building.pop(file_hash, None)
+            # a failed build is tried again on the next request
+            if not task.cancelled():
+                task.exception()
+
+        task.add_done_callback(on_built)
+
+    async def get(self, file: str, file_hash: str, accept_encoding: str) -> Tuple[str, str] | None:
+        '''
+        Returns the preferred accepted encoding and the path of its variant, if it has been built.
+        Missing variants are built in the background, compressing a large bundle takes too long to make a request wait for it.
+        '''
+        if not self.is_compressible(file):
+            return None
+        accepted = accepted_encodings(accept_encoding)
+        encodings = [encoding for encoding in self.encodings if encoding in accepted or "*" in accepted]
+        if not encodings:
+            return None
+        if not path.exists(self.variant_path(file_hash, encodings[0])):
+            try:
+                if path.getsize(file) < MIN_COMPRESS_SIZE:
+                    return None
+            except OSError:
+                return None
+            self._build_in_background(file, file_hash)
+        for encoding in encodings:
+            variant = self.variant_path(file_hash, encoding)
+            if path.exists(variant):
+                try:
+                    # prune goes by mtime, variants that are still served are kept
+                    utime(variant)
+                except OSError:
+                    pass
+                return encoding, variant
+        # not built yet
+        return None
+
+    def prune(self, max_age: float = COMPRESSED_VARIANT_MAX_AGE):
+        '''Removes the variants that haven't been built or served for max_age seconds.'''
+        if not path.isdir(self.directory):
+            return
+        for entry in scandir(self.directory):
+            if entry.stat().st_mtime < time() - max_age:
+                remove(entry.path)
+
+class HashedFileResponse(web.FileResponse):
+    '''
+    FileResponse sending the content hash as ETag rather than the one aiohttp derives from mtime and size,
+    so the file is still streamed (with sendfile and Range support) instead of being read into memory.
+    '''
+    def __init__(self, path: str, content_etag: str, **kwargs: Any) -> None:
+        self.content_etag = content_etag
+        super().__init__(path, **kwargs)
+
+    @property
+    def etag(self) -> ETag | None:
+        return super().etag
+
+    @etag.setter
+    def etag(self, value: ETag | str | None) -> None:
+        # aiohttp sets its own ETag while preparing the response, before the headers are sent
+        web.FileResponse.etag.fset(self, self.content_etag) # pyright: ignore [reportOptionalCall, reportAttributeAccessIssue]
+
+async def hashed_file_response(request: web.Request, file: str, file_hash: str | None, immutable: bool = False,
+                               content_type: str | None = None, read: Callable[[str], Awaitable[bytes]] | None = None,
+                               variants: CompressedVariants | None = None) -> web.StreamResponse:
+    '''
+    Serves file with its content hash as ETag, answering matching If-None-Match requests with 304.
+    Files without a hash are served as before, without long-lived caching. read replaces streaming files from disk
+    (for the few files worth keeping in memory), and variants supplies precompressed versions for clients accepting them.
+    '''
+    if file_hash is None:
+        headers = {"Cache-Control": REVALIDATE_CACHE_CONTROL}
+        if content_type:
+            headers["Content-Type"] = content_type
+        return web.FileResponse(file, headers=headers)
+
+    headers = {"Cache-Control": IMMUTABLE_CACHE_CONTROL if immutable else REVALIDATE_CACHE_CONTROL, "ETag": f'"{file_hash}"'}
+    variant = await variants.get(file, file_hash, request.headers.get("Accept-Encoding", "")) if variants else None
+    if variants and variants.is_compressible(file):
+        headers["Vary"] = "Accept-Encoding"
+    if variant:
+        # every encoding is a separate representation with its own ETag
+        headers["ETag"] = f'"{file_hash}-{variant[0]}"'
+        headers["Content-Encoding"] = variant[0]
+    if request.if_none_match and any(etag.value in (headers["ETag"].strip('"'), "*") for etag in request.if_none_match):
+        return web.Response(status=304, headers=headers)
+
+    served_file = variant[1] if variant else file
+    # the type of the original, not of the compressed variant
+    headers["Content-Type"] = content_type or guess_type(file)[0] or "application/octet-stream"
+    if not read:
+        return HashedFileResponse(served_file, headers["ETag"].strip('"'), headers=headers)
+    try:
+        body = await read(served_file)
+    except FileNotFoundError:
+        raise web.HTTPNotFound()
+    return web.Response(body=body, headers=headers)
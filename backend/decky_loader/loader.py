@@ -1,10 +1,12 @@
 from __future__ import annotations
-from asyncio import AbstractEventLoop, Queue, gather, sleep
+from asyncio import AbstractEventLoop, Queue, Semaphore, TimerHandle, gather, sleep, to_thread
 from logging import getLogger
 from os import listdir, path
 from pathlib import Path
+from time import monotonic
 from traceback import print_exc, format_exc
-from typing import Any, Tuple, Dict, cast
+from inspect import isasyncgen
+from typing import Any, AsyncGenerator, Callable, Tuple, Dict, cast
 
 from aiohttp import web
 from os.path import exists
@@ -17,26 +19,47 @@ if TYPE_CHECKING:
     from .main import PluginManager
 
 from .plugin.plugin import PluginWrapper
-from .wsrouter import WSRouter
+from .plugin.shared_blob import BlobData, SharedBlob, SharedBlobStore
+from .wsrouter import WSRouter, call_deadline
+from .tracing import tracer
+from .content_hash import BundleCache, CompressedVariants, FileHashCache, hashed_file_response
+from .localplatform.localplatform import get_plugin_load_concurrency
 from .enums import PluginLoadType
 
 Plugins = dict[str, PluginWrapper]
+
+# crashed plugin backends are restarted after RESTART_BACKOFF_BASE seconds, doubling with every crash up to
+# RESTART_BACKOFF_MAX, and are given up on after more than MAX_CRASHES crashes within CRASH_WINDOW seconds
+RESTART_BACKOFF_BASE = 1
+RESTART_BACKOFF_MAX = 60
+MAX_CRASHES = 5
+CRASH_WINDOW = 600
+# seconds without further changes to a plugin's files before it is hot reloaded
+RELOAD_DEBOUNCE = 0.5
 ReloadQueue = Queue[Tuple[str, str, bool | None] | Tuple[str, str]]
 
+# (plugin directory, whether the backend changed as well)
+ReloadCallback = Callable[[str, bool], None]
+
 class FileChangeHandler(RegexMatchingEventHandler):
-    def __init__(self, queue: ReloadQueue, plugin_path: str) -> None:
-        super().__init__(regexes=[r'^.*?dist\/index\.js$', r'^.*?main\.py$']) # pyright: ignore [reportUnknownMemberType]
+    def __init__(self, on_change: ReloadCallback, plugin_path: str, loop: AbstractEventLoop) -> None:
+        super().__init__(regexes=[r'^.*?dist\/.*$', r'^.*?main\.py$', r'^.*?py_modules\/.*$']) # pyright: ignore [reportUnknownMemberType]
         self.logger = getLogger("file-watcher")
         self.plugin_path = plugin_path
-        self.queue = queue
+        self.on_change = on_change
+        self.loop = loop
         self.disabled = True
 
     def maybe_reload(self, src_path: str):
         if self.disabled:
             return
-        plugin_dir = Path(path.relpath(src_path, self.plugin_path)).parts[0]
+        parts = Path(path.relpath(src_path, self.plugin_path)).parts
+        plugin_dir = parts[0]
         if exists(path.join(self.plugin_path, plugin_dir, "plugin.json")):
-            self.queue.put_nowait((path.join(self.plugin_path, plugin_dir, "main.py"), plugin_dir, True))
+            # anything outside of dist is only used by the backend
+            backend_changed = len(parts) < 2 or parts[1] != "dist"
+            # called from the observer's thread
+            self.loop.call_soon_threadsafe(self.on_change, plugin_dir, backend_changed)
 
     def on_created(self, event: FileSystemEvent):
         src_path = cast(str, event.src_path) #type: ignore # this is the correct type for this is in later versions of watchdog
@@ -74,15 +97,27 @@ class Loader:
         self.plugin_path = plugin_path
         self.logger.info(f"plugin_path: {self.plugin_path}")
         self.plugins: Plugins = {}
+        # monotonic() times of each plugin's recent crashes
+        self.plugin_crashes: Dict[str, List[float]] = {}
         self.watcher = None
         self.live_reload = live_reload
         self.reload_queue: ReloadQueue = Queue()
+        # plugins with changes waiting for the reload debounce, and whether their backend changed
+        self.pending_reloads: Dict[str, bool] = {}
+        self.reload_timers: Dict[str, TimerHandle] = {}
         self.loop.create_task(self.handle_reloads())
         self.context: PluginManager = server_instance
+        self.shared_blobs = SharedBlobStore()
+        # content hashes of the loader's own frontend files and locales
+        self.file_hashes = FileHashCache()
+        # plugins' dist/index.js, served by both handle_plugin_dist and handle_frontend_bundle
+        self.bundle_cache = BundleCache()
+        # gzip/brotli variants of the frontend files and plugin bundles, built on install and on first request
+        self.compressed_assets = CompressedVariants(path.join(get_homebrew_path(), "cache", "compressed_assets"))
 
         if live_reload:
             self.observer = Observer()
-            self.watcher = FileChangeHandler(self.reload_queue, plugin_path)
+            self.watcher = FileChangeHandler(self.schedule_reload, plugin_path, self.loop)
             self.observer.schedule(self.watcher, self.plugin_path, recursive=True) # pyright: ignore [reportUnknownMemberType]
             self.observer.start()
             self.loop.create_task(self.enable_reload_wait())
@@ -94,10 +129,17 @@ class Loader:
             web.get("/plugins/{plugin_name}/dist/{path:.*}", self.handle_plugin_dist),
             web.get("/plugins/{plugin_name}/assets/{path:.*}", self.handle_plugin_frontend_assets),
             web.get("/plugins/{plugin_name}/data/{path:.*}", self.handle_plugin_frontend_assets_from_data),
+            web.get("/shared_blobs/{token}", self.shared_blobs.handle),
+            web.get("/debug/call_trace", self.handle_call_trace),
         ])
 
         server_instance.ws.add_route("loader/get_plugins", self.get_plugins)
+        server_instance.ws.add_route("loader/get_plugin_metrics", self.get_plugin_metrics)
+        server_instance.ws.add_route("loader/get_ws_metrics", server_instance.ws.get_metrics)
+        server_instance.ws.add_route("loader/get_plugin_stats", self.get_plugin_stats)
+        server_instance.ws.add_route("loader/get_call_latencies", tracer.get_latencies)
         server_instance.ws.add_route("loader/reload_plugin", self.handle_plugin_backend_reload)
+        server_instance.ws.add_route("loader/reload_plugin_frontend", self.handle_plugin_frontend_reload)
         server_instance.ws.add_route("loader/call_plugin_method", self.handle_plugin_method_call)
         server_instance.ws.add_route("loader/call_legacy_plugin_method", self.handle_plugin_method_call_legacy)
 
@@ -117,33 +159,58 @@ class Loader:
             self.live_reload = False
 
     async def handle_frontend_assets(self, request: web.Request):
-        file = Path(__file__).parent.joinpath("static").joinpath(request.match_info["path"])
-        return web.FileResponse(file, headers={"Cache-Control": "no-cache"})
+        file = str(Path(__file__).parent.joinpath("static").joinpath(request.match_info["path"]))
+        return await hashed_file_response(request, file, await self.file_hashes.get(file), variants=self.compressed_assets)
 
     async def handle_frontend_locales(self, request: web.Request):
         req_lang = request.match_info["path"]
         file = Path(__file__).parent.joinpath("locales").joinpath(req_lang)
         if exists(file):
-            return web.FileResponse(file, headers={"Cache-Control": "no-cache", "Content-Type": "application/json"})
+            return await hashed_file_response(request, str(file), await self.file_hashes.get(str(file)), content_type="application/json",
+                                              variants=self.compressed_assets)
         else:
             self.logger.info(f"Language {req_lang} not available, returning an empty dictionary")
             return web.json_response(data={}, headers={"Cache-Control": "no-cache"})
 
     async def get_plugins(self):
         plugins = list(self.plugins.values())
-        return [{"name": str(i), "version": i.version, "load_type": i.load_type, "disabled": i.disabled} for i in plugins]
+        return [{"name": str(i), "version": i.version, "load_type": i.load_type, "disabled": i.disabled, "hash": i.dist_hash} for i in plugins]
+
+    async def get_plugin_metrics(self):
+        return {name: plugin.get_metrics() for name, plugin in self.plugins.items()}
+
+    async def get_plugin_stats(self, plugin_name: str | None = None):
+        if plugin_name is not None:
+            return self.plugins[plugin_name].get_stats()
+        return {name: plugin.get_stats() for name, plugin in self.plugins.items()}
+
+    async def handle_call_trace(self, request: web.Request):
+        # open the file in chrome://tracing or ui.perfetto.dev
+        return web.json_response(tracer.export_chrome_trace(), headers={"Content-Disposition": "attachment; filename=decky-call-trace.json"})
 
     async def handle_plugin_dist(self, request: web.Request):
         plugin = self.plugins[request.match_info["plugin_name"]]
         file = path.join(self.plugin_path, plugin.plugin_directory, "dist", request.match_info["path"])
 
-        return web.FileResponse(file, headers={"Cache-Control": "no-cache"})
+        return await self._dist_file_response(request, plugin, request.match_info["path"], file)
 
     async def handle_plugin_frontend_assets(self, request: web.Request):
         plugin = self.plugins[request.match_info["plugin_name"]]
         file = path.join(self.plugin_path, plugin.plugin_directory, "dist/assets", request.match_info["path"])
 
-        return web.FileResponse(file, headers={"Cache-Control": "no-cache"})
+        return await self._dist_file_response(request, plugin, f"assets/{request.match_info['path']}", file)
+
+    async def _dist_file_response(self, request: web.Request, plugin: PluginWrapper, dist_path: str, file: str, content_type: str | None = None):
+        # URLs versioned with the current hash of the plugin's dist folder never change, see importReactPlugin in plugin-loader.tsx
+        immutable = plugin.dist_hash is not None and request.query.get("v") == plugin.dist_hash
+        read = self.bundle_cache.get if dist_path == "index.js" else None
+        return await hashed_file_response(request, file, plugin.dist_hashes.get(dist_path), immutable, content_type, read, self.compressed_assets)
+
+    async def precompress_plugin(self, plugin: PluginWrapper):
+        try:
+            await to_thread(self.compressed_assets.build_directory, path.join(self.plugin_path, plugin.plugin_directory, "dist"), plugin.dist_hashes)
+        except Exception as e:
+            self.logger.warning(f"Could not precompress the frontend of {plugin.get_display_name()}: {e}")
 
     async def handle_plugin_frontend_assets_from_data(self, request: web.Request):
         plugin = self.plugins[request.match_info["plugin_name"]]
@@ -155,16 +222,18 @@ class Loader:
     async def handle_frontend_bundle(self, request: web.Request):
         plugin = self.plugins[request.match_info["plugin_name"]]
 
-        with open(path.join(self.plugin_path, plugin.plugin_directory, "dist/index.js"), "r", encoding="utf-8") as bundle:
-            return web.Response(text=bundle.read(), content_type="application/javascript")
+        return await self._dist_file_response(request, plugin, "index.js", path.join(self.plugin_path, plugin.plugin_directory, "dist/index.js"),
+                                              "application/javascript")
 
     async def import_plugin(self, file: str, plugin_directory: str, refresh: bool | None = False, batch: bool | None = False):
         try:
             async def plugin_emitted_event(event: str, args: Any):
                 self.logger.debug(f"PLUGIN EMITTED EVENT: {event} with args {args}")
-                await self.ws.emit(f"loader/plugin_event", {"plugin": plugin.name, "event": event, "args": args})
+                await self.ws.emit(f"loader/plugin_event", {"plugin": plugin.name, "event": event, "args": args}, topic=f"loader/plugin_event/{plugin.name}/{event}")
 
-            plugin = PluginWrapper(file, plugin_directory, self.plugin_path, plugin_emitted_event)
+            start_time = monotonic()
+            # reading plugin.json and fixing permissions blocks on the filesystem and on chown, keep it off the event loop
+            plugin = await to_thread(PluginWrapper, file, plugin_directory, self.plugin_path, plugin_emitted_event, self.handle_plugin_crash)
             if hasattr(self.context, "utilities") and plugin.name in await self.context.utilities.get_setting("disabled_plugins",[]):
                 plugin.disabled = True
                 self.plugins[plugin.name] = plugin
@@ -179,37 +248,118 @@ class Loader:
             if plugin.passive:
                 self.logger.info(f"Plugin {plugin.get_display_name()} is passive")
 
+            if hasattr(self.context, "utilities"):
+                # limits from the settings win over the ones the plugin declares
+                plugin.limits.update((await self.context.utilities.get_setting("plugin_limits", {})).get(plugin.name, {}))
+            # a reloaded plugin may not coalesce the same events anymore
+            self.ws.remove_coalesced_events(f"loader/plugin_event/{plugin.name}/")
+            for event, interval in plugin.coalesced_events.items():
+                self.ws.coalesce_event(f"loader/plugin_event/{plugin.name}/{event}", interval / 1000)
             self.plugins[plugin.name] = plugin.start()
-            self.logger.info(f"Loaded {plugin.get_display_name()}")
+            plugin.load_time = monotonic() - start_time
+            self.logger.info(f"Loaded {plugin.get_display_name()} in {plugin.load_time:.2f}s")
             if not batch:
-                self.loop.create_task(self.dispatch_plugin(plugin.name, plugin.version, plugin.load_type))
+                self.loop.create_task(self.dispatch_plugin(plugin.name, plugin.version, plugin.load_type, plugin.dist_hash))
         except Exception as e:
             self.logger.error(f"Could not load {file}. {e}")
             print_exc()
 
-    async def dispatch_plugin(self, name: str, version: str | None, load_type: int = PluginLoadType.ESMODULE_V1.value):
-        await self.ws.emit("loader/import_plugin", name, version, load_type, True, 15000)        
+    async def handle_plugin_crash(self, plugin: PluginWrapper):
+        now = monotonic()
+        # only recent crashes count towards the crash loop limit
+        crashes = [crash for crash in self.plugin_crashes.get(plugin.name, []) if now - crash < CRASH_WINDOW] + [now]
+        self.plugin_crashes[plugin.name] = crashes
+        restarting = len(crashes) <= MAX_CRASHES
+        await self.ws.emit("loader/plugin_crashed", plugin.name, plugin.proc.exitcode if plugin.proc else None, restarting, plugin.limit_violation)
+        if not restarting:
+            self.logger.error(f"{plugin.get_display_name()} crashed {len(crashes)} times in {CRASH_WINDOW:.0f}s, not restarting it again")
+            return
+
+        delay = min(RESTART_BACKOFF_BASE * 2 ** (len(crashes) - 1), RESTART_BACKOFF_MAX)
+        self.logger.warning(f"{plugin.get_display_name()} crashed, restarting it in {delay:.0f}s")
+        await sleep(delay)
+        # the plugin could have been reloaded, disabled or uninstalled in the meantime
+        if self.plugins.get(plugin.name) is plugin:
+            await plugin.restart()
+
+    async def dispatch_plugin(self, name: str, version: str | None, load_type: int = PluginLoadType.ESMODULE_V1.value, dist_hash: str | None = None):
+        await self.ws.emit("loader/import_plugin", name, version, load_type, True, 15000, dist_hash)        
 
     async def import_plugins(self):
         self.logger.info(f"import plugins from {self.plugin_path}")
+        try:
+            await to_thread(self.compressed_assets.prune)
+        except Exception as e:
+            self.logger.warning(f"Could not prune compressed assets: {e}")
 
+        start_time = monotonic()
         directories = [i for i in listdir(self.plugin_path) if path.isdir(path.join(self.plugin_path, i)) and path.isfile(path.join(self.plugin_path, i, "plugin.json"))]
-        for directory in directories:
-            self.logger.info(f"found plugin: {directory}")
-            await self.import_plugin(path.join(self.plugin_path, directory, "main.py"), directory, False, True)
+        semaphore = Semaphore(get_plugin_load_concurrency())
+
+        async def import_directory(directory: str):
+            async with semaphore:
+                self.logger.info(f"found plugin: {directory}")
+                await self.import_plugin(path.join(self.plugin_path, directory, "main.py"), directory, False, True)
+
+        await gather(*[import_directory(directory) for directory in directories])
+
+        # plugins finish loading in any order, keep them in directory order like a sequential import would
+        order = {directory: index for index, directory in enumerate(directories)}
+        plugins = sorted(self.plugins.items(), key=lambda item: order.get(item[1].plugin_directory, len(order)))
+        self.plugins.clear()
+        self.plugins.update(plugins)
+        self.logger.info(f"Imported {len(directories)} plugins in {monotonic() - start_time:.2f}s")
+
+    def schedule_reload(self, plugin_directory: str, backend_changed: bool):
+        # bundlers write many files in a row, the plugin is reloaded once they have been quiet for RELOAD_DEBOUNCE seconds
+        self.pending_reloads[plugin_directory] = self.pending_reloads.get(plugin_directory, False) or backend_changed
+        timer = self.reload_timers.pop(plugin_directory, None)
+        if timer:
+            timer.cancel()
+        self.reload_timers[plugin_directory] = self.loop.call_later(RELOAD_DEBOUNCE, self._reload_changed_plugin, plugin_directory)
+
+    def _reload_changed_plugin(self, plugin_directory: str):
+        self.reload_timers.pop(plugin_directory, None)
+        backend_changed = self.pending_reloads.pop(plugin_directory, True)
+        self.bundle_cache.invalidate(path.join(self.plugin_path, plugin_directory))
+        plugin = next((plugin for plugin in self.plugins.values() if plugin.plugin_directory == plugin_directory), None)
+        if plugin and plugin.disabled:
+            # picked up again once the plugin gets enabled
+            return
+        if backend_changed or not plugin:
+            self.reload_queue.put_nowait((path.join(self.plugin_path, plugin_directory, "main.py"), plugin_directory, True))
+        elif not "debug" in plugin.flags:
+            self.logger.info(f"Plugin {plugin.get_display_name()} is already loaded and has requested to not be re-loaded")
+        else:
+            self.loop.create_task(self.reload_plugin_frontend(plugin))
+
+    async def reload_plugin_frontend(self, plugin: PluginWrapper):
+        if plugin.disabled:
+            return
+        # the backend and its state stay alive, the frontend swaps in the module with the new hash
+        await to_thread(plugin.refresh_dist_hashes)
+        self.logger.info(f"Reloading the frontend of {plugin.get_display_name()}")
+        await self.ws.emit("loader/reload_frontend", plugin.name, plugin.version, plugin.load_type, plugin.dist_hash)
+
+    async def handle_plugin_frontend_reload(self, plugin_name: str):
+        await self.reload_plugin_frontend(self.plugins[plugin_name])
 
     async def handle_reloads(self):
         while True:
             args = await self.reload_queue.get()
             await self.import_plugin(*args) # pyright: ignore [reportArgumentType]
 
+    def _remaining_call_time(self) -> float | None:
+        deadline = call_deadline.get()
+        return max(deadline - monotonic(), 0) if deadline is not None else None
+
     async def handle_plugin_method_call_legacy(self, plugin_name: str, method_name: str, kwargs: Dict[Any, Any]):
         res: Dict[Any, Any] = {}
         plugin = self.plugins[plugin_name]
         try:
           if method_name.startswith("_"):
               raise RuntimeError(f"Plugin {plugin.get_display_name()} tried to call private method {method_name}")
-          res["result"] = await plugin.execute_legacy_method(method_name, kwargs)
+          res["result"] = await plugin.execute_legacy_method(method_name, kwargs, self._remaining_call_time())
           res["success"] = True
         except Exception as e:
             res["result"] = str(e)
@@ -221,12 +371,31 @@ class Loader:
         try:
           if method_name.startswith("_"):
               raise RuntimeError(f"Plugin {plugin.get_display_name()} tried to call private method {method_name}")
-          result = await plugin.execute_method(method_name, *args)
+          result = self._share_blobs(await plugin.execute_method(method_name, *args, timeout=self._remaining_call_time()))
         except Exception as e:
             self.logger.error(f"Method {method_name} of plugin {plugin.get_display_name()} failed with the following exception:\n{format_exc()}")
             raise e # throw again to pass the error to the frontend
         return result
 
+    def _share_blobs(self, result: Any) -> Any:
+        # the frontend fetches shared blobs separately, see resolveSharedBlob in plugin-loader.tsx
+        if isinstance(result, SharedBlob):
+            return {"__decky_shared_blob__": self.shared_blobs.add(result), "size": result.size}
+        if isinstance(result, (bytes, bytearray, memoryview)):
+            # binary codecs carry bytes over the plugin socket, the frontend gets them the same way as shared blobs
+            data = bytes(cast(BlobData, result))
+            return {"__decky_shared_blob__": self.shared_blobs.add(data), "size": len(data)}
+        if isasyncgen(result):
+            return self._share_streamed_blobs(cast(AsyncGenerator[Any, None], result))
+        return result
+
+    async def _share_streamed_blobs(self, results: AsyncGenerator[Any, None]) -> AsyncGenerator[Any, None]:
+        try:
+            async for result in results:
+                yield self._share_blobs(result)
+        finally:
+            await results.aclose()
+
     async def handle_plugin_backend_reload(self, plugin_name: str):
         plugin = self.plugins[plugin_name]
 
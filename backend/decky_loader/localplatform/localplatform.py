@@ -38,6 +38,34 @@ def get_server_port() -> int:
 def get_live_reload() -> bool:
     return os.getenv("LIVE_RELOAD", "1") == "1"
 
+def get_method_call_timeout() -> float:
+    '''Seconds a plugin method call may run before it is cancelled, unless the frontend asked for a shorter deadline'''
+    return float(os.getenv("METHOD_CALL_TIMEOUT", "300"))
+
+def get_plugin_load_concurrency() -> int:
+    '''Number of plugins loaded at the same time during startup'''
+    return max(1, int(os.getenv("PLUGIN_LOAD_CONCURRENCY", "4")))
+
+def get_plugin_start_method() -> str:
+    '''multiprocessing start method for plugin processes, empty for the platform default'''
+    return os.getenv("PLUGIN_START_METHOD", "forkserver" if ON_LINUX else "")
+
+def get_lazy_plugin_backends() -> bool:
+    '''Start the backends of plugins without a _main task only once they are called'''
+    return os.getenv("LAZY_PLUGIN_BACKENDS", "0") == "1"
+
+def get_plugin_idle_timeout() -> float:
+    '''Seconds without calls after which a lazily started backend is stopped again, 0 to keep it running'''
+    return float(os.getenv("PLUGIN_IDLE_TIMEOUT", "300"))
+
+def get_plugin_stats_interval() -> float:
+    '''Seconds between two resource usage samples of a plugin process, 0 to disable sampling'''
+    return float(os.getenv("PLUGIN_STATS_INTERVAL", "10"))
+
+def get_call_tracing() -> bool:
+    '''Record the timings of every frontend call, see tracing.py. Off by default, it adds work to every call'''
+    return os.getenv("CALL_TRACING", "0") == "1"
+
 def get_keep_systemd_service() -> bool:
     return os.getenv("KEEP_SYSTEMD_SERVICE", "0") == "1"
 
@@ -3,7 +3,7 @@ from asyncio import Lock, create_subprocess_exec
 from asyncio.subprocess import PIPE, DEVNULL, STDOUT, Process
 from subprocess import call as call_sync
 import os, pwd, grp, sys, logging
-from typing import IO, Any, Mapping
+from typing import IO, Any, Dict, Mapping
 from ..enums import UserType
 
 logger = logging.getLogger("localplatform")
@@ -336,3 +336,31 @@ async def close_cef_socket():
             return
 
         logger.info("CEF socket closed")
+
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+
+def get_process_stats(pid: int) -> Dict[str, float] | None:
+    '''CPU seconds used so far, resident memory in bytes, open file descriptors and threads of a process, None if it is gone'''
+    try:
+        with open(f"/proc/{pid}/stat", "r") as f:
+            # the process name may contain spaces and parentheses, the fields after it don't. the first one left is field 3 (state)
+            fields = f.read().rsplit(")", 1)[1].split()
+        stats: Dict[str, float] = {"cpu_time": (int(fields[11]) + int(fields[12])) / CLOCK_TICKS, "rss": 0, "threads": 0}
+        with open(f"/proc/{pid}/status", "r") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    stats["rss"] = int(line.split()[1]) * 1024
+                elif line.startswith("Threads:"):
+                    stats["threads"] = int(line.split()[1])
+        stats["fds"] = len(os.listdir(f"/proc/{pid}/fd"))
+        return stats
+    except (OSError, IndexError, ValueError):
+        return None
+
+def set_process_limits(max_address_space: int | None = None, max_open_files: int | None = None):
+    '''Limits the virtual address space (in bytes, which is more than the memory in use) and the number of open files of the calling process and its children'''
+    import resource
+    if max_address_space is not None:
+        resource.setrlimit(resource.RLIMIT_AS, (max_address_space, max_address_space))
+    if max_open_files is not None:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (max_open_files, max_open_files))
@@ -1,5 +1,6 @@
 from ..enums import UserType
 import os
+from typing import Dict
 from . import localplatformlinux
 
 # this should be public
@@ -56,4 +57,10 @@ async def restart_webhelper() -> bool:
     return await localplatformlinux.restart_webhelper()
 
 async def close_cef_socket():
-    return # Stubbed
\ No newline at end of file
+    return # Stubbed
+
+def get_process_stats(pid: int) -> Dict[str, float] | None:
+    return None # Stubbed, there is no /proc
+
+def set_process_limits(max_address_space: int | None = None, max_open_files: int | None = None):
+    return localplatformlinux.set_process_limits(max_address_space, max_open_files)
@@ -1,5 +1,6 @@
 from ..enums import UserType
 import os, sys
+from typing import Dict
 
 def chown(path : str,  user : UserType = UserType.HOST_USER, recursive : bool = True) -> bool:
     return True # Stubbed
@@ -61,4 +62,10 @@ async def restart_webhelper() -> bool:
     return True # Stubbed
 
 async def close_cef_socket():
-    return # Stubbed
\ No newline at end of file
+    return # Stubbed
+
+def get_process_stats(pid: int) -> Dict[str, float] | None:
+    return None # Stubbed
+
+def set_process_limits(max_address_space: int | None = None, max_open_files: int | None = None):
+    return # Stubbed
@@ -1,4 +1,9 @@
-import asyncio, time
+import asyncio
+from multiprocessing import Pipe
+from os import unlink
+from socket import socketpair
+from uuid import uuid4
+from struct import Struct
 from typing import Any, Callable, Coroutine
 import random
 
@@ -6,32 +11,99 @@ from .localplatform import ON_WINDOWS
 
 BUFFER_LIMIT = 2 ** 20  # 1 MiB
 
+# seconds to wait for the sandboxed process to report its server is listening, before falling back to retrying the connection
+READY_TIMEOUT = 20
+
+# 4 byte big-endian payload length, followed by the payload itself
+FRAME_HEADER = Struct("!I")
+# a header announcing more than this is treated as a broken connection rather than read
+MAX_FRAME_SIZE = 2 ** 28  # 256 MiB
+
+class FrameTooLarge(Exception):
+    pass
+
 class UnixSocket:
+    # whether the client has to wait for the sandboxed process to report its server is listening
+    uses_ready_pipe = True
+
     def __init__(self):
         '''
-        on_new_message takes 1 string argument.
+        on_new_message takes 1 bytes argument.
         It's return value gets used, if not None, to write data to the socket.
-        Method should be async
+        Method should be async and return quickly, it is awaited before the next message is read.
         '''
-        self.socket_addr = f"/tmp/plugin_socket_{time.time()}"
+        self.socket_addr = f"/tmp/plugin_socket_{uuid4().hex}"
         self.on_new_message = None
         self.socket = None
-        self.reader = None
-        self.writer = None
-        self.server_writer = None
+        self.reader: asyncio.StreamReader | None = None
+        self.writer: asyncio.StreamWriter | None = None
+        self.server_writer: asyncio.StreamWriter | None = None
         self.open_lock = asyncio.Lock()
         self.active = True
+        # the sandboxed process reports on this pipe once its server is listening, so the first connection doesn't have to guess
+        self.ready = not self.uses_ready_pipe
+        self._ready_reader, self._ready_writer = Pipe(duplex=False) if self.uses_ready_pipe else (None, None)
 
-    async def setup_server(self, on_new_message: Callable[[str], Coroutine[Any, Any, Any]]):
+    async def setup_server(self, on_new_message: Callable[[bytes], Coroutine[Any, Any, bytes | None]]):
         try:
             self.on_new_message = on_new_message
             self.socket = await asyncio.start_unix_server(self._listen_for_method_call, path=self.socket_addr, limit=BUFFER_LIMIT)
+            self._signal_ready()
         except asyncio.CancelledError:
             await self.close_socket_connection()
             raise
 
+    def _signal_ready(self):
+        if self._ready_writer is None:
+            return
+        try:
+            self._ready_writer.send_bytes(b"1")
+            self._ready_writer.close()
+        except:
+            pass
+
+    def server_started(self):
+        '''
+        Called by the client once the process running the server has been started. Closes the client's copy of
+        the ready pipe's writing end, so the pipe reports EOF if that process exits before its server is listening.
+        '''
+        if self._ready_writer is not None:
+            self._ready_writer.close()
+
+    async def _wait_for_server(self) -> bool | None:
+        '''True once the server is listening, False if its process exited before that, None if it can't tell'''
+        if self.ready or self._ready_reader is None:
+            return True
+        try:
+            if not await self._poll_ready(READY_TIMEOUT):
+                return None
+            self._ready_reader.recv_bytes()
+            self.ready = True
+            self._ready_reader.close()
+            return True
+        except EOFError:
+            return False
+        except:
+            return None
+
+    async def _poll_ready(self, timeout: float) -> bool:
+        assert self._ready_reader
+        loop = asyncio.get_running_loop()
+        readable: asyncio.Future[None] = loop.create_future()
+        fd = self._ready_reader.fileno()
+        loop.add_reader(fd, lambda: readable.done() or readable.set_result(None))
+        try:
+            await asyncio.wait_for(readable, timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            loop.remove_reader(fd)
+
     async def _open_socket_if_not_exists(self):
         if not self.reader:
+            if await self._wait_for_server() is False:
+                return False
             retries = 0
             while retries < 10:
                 try:
@@ -60,10 +132,19 @@ class UnixSocket:
         if self.socket:
             self.socket.close()
             await self.socket.wait_closed()
+
+        try:
+            unlink(self.socket_addr)
+        except:
+            pass
         
         self.active = False
 
-    async def read_single_line(self) -> str|None:
+    def at_eof(self) -> bool:
+        '''True once the client connection has been closed by the other end and everything has been read'''
+        return self.reader is not None and self.reader.at_eof()
+
+    async def read_message(self) -> bytes|None:
         reader, _ = await self.get_socket_connection()
 
         try:
@@ -71,9 +152,9 @@ class UnixSocket:
         except AssertionError:
             return
 
-        return await self._read_single_line(reader)
+        return await self._read_message(reader)
 
-    async def write_single_line(self, message : str):
+    async def write_message(self, message : bytes):
         _, writer = await self.get_socket_connection()
 
         try:
@@ -81,71 +162,78 @@ class UnixSocket:
         except AssertionError:
             return
 
-        await self._write_single_line(writer, message)
+        await self._write_message(writer, message)
 
-    async def _read_single_line(self, reader: asyncio.StreamReader) -> str:
-        line = bytearray()
-        while self.active:
-            try:
-                line.extend(await reader.readuntil())
-            except asyncio.LimitOverrunError:
-                line.extend(await reader.read(reader._limit)) # pyright: ignore [reportUnknownMemberType, reportUnknownArgumentType, reportAttributeAccessIssue]
-                continue
-            except asyncio.IncompleteReadError as err:
-                line.extend(err.partial)
-                break
-            except asyncio.CancelledError:
-                raise
-            else:
-                break
-
-        return line.decode("utf-8")
-    
-    async def _write_single_line(self, writer: asyncio.StreamWriter, message : str):
-        if not message.endswith("\n"):
-            message += "\n"
+    async def _read_message(self, reader: asyncio.StreamReader) -> bytes:
+        # readexactly is not bound by the reader limit and hands back the payload in one piece,
+        # so there is no need to scan for a delimiter or grow a buffer
+        try:
+            header = await reader.readexactly(FRAME_HEADER.size)
+            (length,) = FRAME_HEADER.unpack(header)
+            if length > MAX_FRAME_SIZE:
+                # the rest of the stream can't be trusted either, there is no telling where the next frame starts
+                raise FrameTooLarge(f"Frame of {length} bytes exceeds the limit of {MAX_FRAME_SIZE} bytes")
+            return await reader.readexactly(length)
+        except asyncio.IncompleteReadError:
+            # connection closed, possibly in the middle of a frame
+            return b""
 
-        writer.write(message.encode("utf-8"))
+    async def _write_message(self, writer: asyncio.StreamWriter, message : bytes):
+        if len(message) > MAX_FRAME_SIZE:
+            raise FrameTooLarge(f"Message of {len(message)} bytes exceeds the limit of {MAX_FRAME_SIZE} bytes")
+        writer.writelines((FRAME_HEADER.pack(len(message)), message))
         await writer.drain()
     
-    async def write_single_line_server(self, message: str):
+    async def write_message_server(self, message: bytes):
         if self.server_writer is None:
             return
-        await self._write_single_line(self.server_writer, message)
+        await self._write_message(self.server_writer, message)
 
     async def _listen_for_method_call(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
         self.server_writer = writer
         while self.active and self.on_new_message:
-
-            def _(task: asyncio.Task[str|None]):
-                res = task.result()
-                if res is not None:
-                    asyncio.create_task(self._write_single_line(writer, res))
-
-            line = await self._read_single_line(reader)
-            asyncio.create_task(self.on_new_message(line)).add_done_callback(_)
+            try:
+                message = await self._read_message(reader)
+            except FrameTooLarge:
+                writer.close()
+                break
+            if not message and reader.at_eof():
+                break
+            # messages are handed over one at a time, so a slow on_new_message stops further reads
+            # and the peer's writes eventually block. long running work has to be scheduled by the callee.
+            res = await self.on_new_message(message)
+            if res is not None:
+                await self._write_message(writer, res)
             
 class PortSocket (UnixSocket):
     def __init__(self):
         '''
-        on_new_message takes 1 string argument.
+        on_new_message takes 1 bytes argument.
         It's return value gets used, if not None, to write data to the socket.
-        Method should be async
+        Method should be async and return quickly, it is awaited before the next message is read.
         '''
         super().__init__()
         self.host = "127.0.0.1"
         self.port = random.sample(range(40000, 60000), 1)[0]
     
-    async def setup_server(self, on_new_message: Callable[[str], Coroutine[Any, Any, Any]]):
+    async def setup_server(self, on_new_message: Callable[[bytes], Coroutine[Any, Any, bytes | None]]):
         try:
             self.on_new_message = on_new_message
             self.socket = await asyncio.start_server(self._listen_for_method_call, host=self.host, port=self.port, limit=BUFFER_LIMIT)
+            self._signal_ready()
         except asyncio.CancelledError:
             await self.close_socket_connection()
             raise
 
+    async def _poll_ready(self, timeout: float) -> bool:
+        # pipes can't be watched by the event loop on windows
+        assert self._ready_reader
+        return await asyncio.to_thread(self._ready_reader.poll, timeout)
+
     async def _open_socket_if_not_exists(self):
         if not self.reader:
+            if await self._wait_for_server() is False:
+                return False
             retries = 0
             while retries < 10:
                 try:
@@ -158,9 +246,58 @@ class PortSocket (UnixSocket):
         else:
             return True
 
+class PairSocket (UnixSocket):
+    # connected from the start, there is nothing to wait for
+    uses_ready_pipe = False
+
+    def __init__(self):
+        '''
+        on_new_message takes 1 bytes argument.
+        It's return value gets used, if not None, to write data to the socket.
+        Method should be async and return quickly, it is awaited before the next message is read.
+
+        Both ends are connected before the sandboxed process is started, which inherits the server end.
+        There is no address to bind or connect to, and no file to clean up.
+        '''
+        super().__init__()
+        self._client_socket, self._server_socket = socketpair()
+
+    async def setup_server(self, on_new_message: Callable[[bytes], Coroutine[Any, Any, bytes | None]]):
+        try:
+            self.on_new_message = on_new_message
+            self._client_socket.close()
+            reader, writer = await asyncio.open_unix_connection(sock=self._server_socket, limit=BUFFER_LIMIT)
+            self._server_task = asyncio.create_task(self._listen_for_method_call(reader, writer))
+        except asyncio.CancelledError:
+            await self.close_socket_connection()
+            raise
+
+    def server_started(self):
+        super().server_started()
+        # with the sandboxed process holding the only server end, its exit shows up as EOF on the client end
+        self._server_socket.close()
+
+    async def _open_socket_if_not_exists(self):
+        if not self.reader:
+            # already connected, anything written before the server reads it waits in the socket buffer
+            try:
+                self.reader, self.writer = await asyncio.open_unix_connection(sock=self._client_socket, limit=BUFFER_LIMIT)
+            except:
+                return False
+        return True
+
+    async def close_socket_connection(self):
+        if self.writer is not None:
+            self.writer.close()
+        else:
+            self._client_socket.close()
+
+        self.reader = None
+        self.active = False
+
 if ON_WINDOWS:
     class LocalSocket (PortSocket):  # type: ignore
         pass
 else:
-    class LocalSocket (UnixSocket):
+    class LocalSocket (PairSocket):
         pass
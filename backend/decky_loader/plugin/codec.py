@@ -0,0 +1,71 @@
+from json import dumps, loads
+from typing import Any, Dict
+
+# Optional, faster codecs. Both ends of the plugin socket run from the same environment,
+# so whatever is importable here is importable in the sandboxed process as well.
+# Neither is a dependency of decky-loader, release builds always use json. They are picked up when
+# installed into the environment the loader runs from (e.g. `pip install msgpack orjson` for a source checkout).
+try:
+    import msgpack # pyright: ignore [reportMissingImports, reportMissingTypeStubs]
+except ImportError:
+    msgpack = None
+
+try:
+    import orjson # pyright: ignore [reportMissingImports]
+except ImportError:
+    orjson = None
+
+class Codec:
+    '''
+    Serializes messages sent over the plugin socket.
+    The default implementation uses the stdlib json module.
+    '''
+    name = "json"
+
+    def dumps(self, obj: Any) -> bytes:
+        return dumps(obj, ensure_ascii=False).encode("utf-8")
+
+    def loads(self, data: bytes) -> Any:
+        return loads(data)
+
+class OrjsonCodec(Codec):
+    name = "orjson"
+
+    def dumps(self, obj: Any) -> bytes:
+        assert orjson
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS) # pyright: ignore [reportUnknownMemberType, reportUnknownVariableType]
+
+    def loads(self, data: bytes) -> Any:
+        assert orjson
+        return orjson.loads(data) # pyright: ignore [reportUnknownMemberType, reportUnknownVariableType]
+
+class MsgpackCodec(Codec):
+    name = "msgpack"
+
+    # bytes are packed as-is, so plugins can return binary data without base64-encoding it first
+    def dumps(self, obj: Any) -> bytes:
+        # msgpack ships no type information, packb always returns bytes
+        packed = msgpack.packb(obj, use_bin_type=True) # pyright: ignore [reportUnknownMemberType, reportUnknownVariableType]
+        # packb only returns None when given a custom stream to write to
+        assert isinstance(packed, bytes)
+        return packed
+
+    def loads(self, data: bytes) -> Any:
+        assert msgpack
+        return msgpack.unpackb(data, raw=False, strict_map_key=False) # pyright: ignore [reportUnknownMemberType, reportUnknownVariableType]
+
+CODECS: Dict[str, Codec] = {codec.name: codec for codec in [Codec(), OrjsonCodec(), MsgpackCodec()]}
+
+def get_codec(name: str) -> Codec:
+    return CODECS.get(name, CODECS["json"])
+
+def negotiate_codec() -> str:
+    '''
+    Picks the fastest codec available for a connection.
+    msgpack carries bytes results as they are, Loader._share_blobs hands those to the frontend as blob URLs.
+    '''
+    if msgpack:
+        return MsgpackCodec.name
+    if orjson:
+        return OrjsonCodec.name
+    return Codec.name
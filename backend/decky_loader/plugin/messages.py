@@ -1,18 +1,32 @@
-from typing import Any, TypedDict
+from typing import Any, AsyncIterator, Dict, TypedDict
 from enum import IntEnum
 from uuid import uuid4
-from asyncio import Event
+from asyncio import Event, Queue, TimeoutError, wait_for
+
+from .shared_blob import SharedBlob
+
+# chunks of a streamed response buffered in the loader, a stream whose consumer falls further behind is cancelled
+STREAM_BUFFER_SIZE = 1024
 
 class SocketMessageType(IntEnum):
     CALL = 0
     RESPONSE = 1
     EVENT = 2
+    CANCEL = 3
 
 class SocketResponseDict(TypedDict):
     type: SocketMessageType
     id: str
     success: bool
     res: Any
+    # calls still waiting in the sandboxed plugin's queue when this response was sent
+    queued: int
+    # set on the chunks of a streamed result, the stream ends with a regular response
+    partial: bool
+    # set if res describes a shared memory segment holding the result, see shared_blob.py
+    blob: bool
+    # monotonic() times the call was received, started and finished at in the sandboxed plugin, if the loader traces it
+    trace: Dict[str, float] | None
 
 class MethodCallResponse:
     def __init__(self, success: bool, result: Any) -> None:
@@ -22,24 +36,90 @@ class MethodCallResponse:
 class PluginStopped(Exception):
     pass
 
+class PluginCrashed(Exception):
+    pass
+
+class MethodCallTimeout(Exception):
+    pass
+
+class StreamOverflow(Exception):
+    pass
+
+def get_result(dc: SocketResponseDict) -> Any:
+    if dc.get("blob"):
+        return SharedBlob(dc["res"]["name"], dc["res"]["size"])
+    return dc["res"]
+
+def discard_result(dc: SocketResponseDict):
+    '''Unlinks the shared memory segment of a response nobody is going to read.'''
+    if dc.get("blob"):
+        get_result(dc).unlink()
+
 class MethodCallRequest:
     def __init__(self) -> None:
         self.id = str(uuid4())
         self.event = Event()
-        self.response: MethodCallResponse | PluginStopped
+        self.response: MethodCallResponse | Exception
+        # created once the first chunk of a streamed result arrives, holds the chunks and the final response in order
+        self.stream: Queue[SocketResponseDict | Exception] | None = None
+        self.timings: Dict[str, float] | None = None
     
     def set_result(self, dc: SocketResponseDict):
-        self.response = MethodCallResponse(dc["success"], dc["res"])
+        self.response = MethodCallResponse(dc["success"], get_result(dc))
+        self.timings = dc.get("trace")
         self.event.set()
 
-    def cancel(self):
-        self.response = PluginStopped("Plugin has been stopped")
+    def add_to_stream(self, dc: SocketResponseDict) -> bool:
+        """Buffers a chunk without waiting for the consumer, returns False once too many chunks are buffered."""
+        if self.stream is None:
+            self.stream = Queue()
+            self.event.set()
+        if self.stream.qsize() >= STREAM_BUFFER_SIZE:
+            return False
+        self.stream.put_nowait(dc)
+        return True
+
+    def cancel(self, error: Exception | None = None):
+        # a result that arrived but was never handed out
+        response = getattr(self, "response", None)
+        if isinstance(response, MethodCallResponse) and isinstance(response.result, SharedBlob):
+            response.result.unlink()
+        self.response = error or PluginStopped("Plugin has been stopped")
+        if self.stream is not None:
+            # nobody is going to read the remaining chunks
+            while not self.stream.empty():
+                dc = self.stream.get_nowait()
+                if not isinstance(dc, Exception):
+                    discard_result(dc)
+            self.stream.put_nowait(self.response)
         self.event.set()
     
-    async def wait_for_result(self):
-        await self.event.wait()
-        if isinstance(self.response, PluginStopped):
+    async def wait_for_result(self, timeout: float | None = None):
+        try:
+            await wait_for(self.event.wait(), timeout)
+        except TimeoutError:
+            raise MethodCallTimeout(f"Method call did not finish within {timeout:.1f}s")
+        if self.stream is not None:
+            # streamed result, read it through iter_stream
+            return None
+        if isinstance(self.response, Exception):
             raise self.response
         if not self.response.success:
             raise Exception(self.response.result)
-        return self.response.result
\ No newline at end of file
+        return self.response.result
+
+    async def iter_stream(self, timeout: float | None = None) -> AsyncIterator[Any]:
+        """Yields the chunks of a streamed result, timeout applies to the wait for each chunk."""
+        assert self.stream is not None
+        while True:
+            try:
+                dc = await wait_for(self.stream.get(), timeout)
+            except TimeoutError:
+                raise MethodCallTimeout(f"No new result chunk within {timeout:.1f}s")
+            if isinstance(dc, Exception):
+                raise dc
+            if not dc["success"]:
+                raise Exception(dc["res"])
+            if not dc["partial"]:
+                return
+            yield get_result(dc)
@@ -1,24 +1,73 @@
-from asyncio import CancelledError, Task, create_task, sleep, wait
-from json import dumps, load, loads
+from ast import AsyncFunctionDef, ClassDef, FunctionDef, parse
+from asyncio import (CancelledError, Future, Lock, Task, TimeoutError, create_task, get_event_loop,
+                     shield, sleep, to_thread, wait, wait_for)
+from json import load
 from logging import getLogger
 from os import path
-from multiprocessing import Process
-from time import time
+from multiprocessing import Process, get_context
+from multiprocessing.context import BaseContext
+from multiprocessing.process import BaseProcess
+from collections import deque
+from time import monotonic, time
 from traceback import format_exc
 
 from .sandboxed_plugin import SandboxedPlugin
-from .messages import MethodCallRequest, SocketMessageType
+from .codec import get_codec, negotiate_codec
+from .messages import STREAM_BUFFER_SIZE, MethodCallRequest, PluginCrashed, SocketMessageType, StreamOverflow, discard_result
 from ..enums import PluginLoadType, UserType
-from ..localplatform.localplatform import file_owner, chown, chmod, get_chown_plugin_path
-from ..localplatform.localsocket import LocalSocket
+from ..localplatform.localplatform import (file_owner, chown, chmod, get_chown_plugin_path, get_method_call_timeout, get_plugin_start_method,
+                                             get_lazy_plugin_backends, get_plugin_idle_timeout,
+                                             get_plugin_stats_interval, get_process_stats)
+from ..localplatform.localsocket import FrameTooLarge, LocalSocket
+from ..tracing import Trace, current_trace
+from ..content_hash import combine_hashes, hash_directory
 from ..helpers import get_homebrew_path, mkdir_as_user
 
-from typing import Any, Callable, Coroutine, Dict, List
+from typing import Any, AsyncIterator, Callable, Coroutine, Deque, Dict, List, Tuple, Type, cast
 
 EmittedEventCallbackType = Callable[[str, Any], Coroutine[Any, Any, Any]]
+CrashCallbackType = Callable[["PluginWrapper"], Coroutine[Any, Any, Any]]
+
+# imported once by the fork server, every plugin process forked from it shares them copy-on-write.
+# only modules that don't read the environment at import time belong here, the decky module reads the plugin's
+# DECKY_* variables and sets up its log file when imported, so it has to be imported by each plugin process itself
+FORKSERVER_PRELOAD = ["decky_loader.plugin.sandboxed_plugin"]
+
+_process_context: BaseContext | None = None
+
+# resource usage samples kept per plugin, an hour's worth at the default interval
+STATS_HISTORY = 360
+LIMIT_VIOLATIONS_BEFORE_KILL = 3
+
+def get_process_context() -> BaseContext:
+    global _process_context
+    if not _process_context:
+        method = get_plugin_start_method()
+        try:
+            _process_context = get_context(method or None)
+        except ValueError:
+            getLogger("plugin").warning(f"Start method {method} is not available, using the default one")
+            _process_context = get_context()
+        if _process_context.get_start_method() == "forkserver":
+            _process_context.set_forkserver_preload(FORKSERVER_PRELOAD) # pyright: ignore [reportAttributeAccessIssue]
+    return _process_context
+
+def has_main_task(file: str) -> bool:
+    '''Whether the Plugin class in file defines _main, without importing it'''
+    try:
+        with open(file, "r", encoding="utf-8") as f:
+            tree = parse(f.read(), file)
+    except Exception:
+        # can't tell, assume it does
+        return True
+    for node in tree.body:
+        if isinstance(node, ClassDef) and node.name == "Plugin":
+            return any(isinstance(item, (FunctionDef, AsyncFunctionDef)) and item.name == "_main" for item in node.body)
+    return False
 
 class PluginWrapper:
-    def __init__(self, file: str, plugin_directory: str, plugin_path: str, emit_callback: EmittedEventCallbackType) -> None:
+    def __init__(self, file: str, plugin_directory: str, plugin_path: str, emit_callback: EmittedEventCallbackType,
+                 crash_callback: CrashCallbackType | None = None) -> None:
         self.file = file
         self.plugin_path = plugin_path
         self.plugin_directory = plugin_directory
@@ -41,9 +90,24 @@ class PluginWrapper:
         self.author = json["author"]
         self.flags = json["flags"]
         self.api_version = json["api_version"] if "api_version" in json else 0
+        self.concurrency = json.get("concurrency", {})
+        # event name -> minimum milliseconds between two sends to the frontend, the latest value wins
+        self.coalesced_events: Dict[str, int] = json.get("coalesced_events", {})
+        # opt-in, bytes results of at least this many bytes skip the socket and are handed over through shared memory
+        self.shared_memory_threshold: int | None = json.get("shared_memory_threshold")
+        # max_address_space (bytes of virtual memory, not memory in use) and max_open_files are applied as rlimits inside the
+        # sandboxed process, the process is killed once it exceeds max_rss (bytes) or max_cpu_percent for LIMIT_VIOLATIONS_BEFORE_KILL samples in a row
+        self.limits: Dict[str, Any] = json.get("limits", {})
         self.disabled = False
+        # content hashes of the files in dist, taken whenever the plugin is (re)loaded. dist_hash changes if any of them does
+        self.dist_hashes: Dict[str, str] = {}
+        self.dist_hash: str | None = None
+        self.refresh_dist_hashes()
         
         self.passive = not path.isfile(self.file)
+        # lazy backends are started by the first method call. Plugins can ask for it with the "lazy" flag, the loader-wide
+        # policy only applies to plugins without a _main task, as nothing would ever start that task otherwise
+        self.lazy = not self.passive and ("lazy" in self.flags or (get_lazy_plugin_backends() and not has_main_task(self.file)))
 
         self.log = getLogger("plugin")
 
@@ -58,13 +122,34 @@ class PluginWrapper:
                 chown(plugin_json_path, UserType.EFFECTIVE_USER, False)
                 chmod(plugin_json_path, 755, False)
 
-        self.sandboxed_plugin = SandboxedPlugin(self.name, self.passive, self.flags, self.file, self.plugin_directory, self.plugin_path, self.version, self.author, self.api_version)
-        self.proc: Process | None = None
+        # the codec is picked here and handed to the sandboxed side so both ends of the socket agree on it
+        self._codec = get_codec(negotiate_codec())
+
+        self.sandboxed_plugin = SandboxedPlugin(self.name, self.passive, self.flags, self.file, self.plugin_directory, self.plugin_path, self.version, self.author, self.api_version, self._codec.name, self.concurrency, self.shared_memory_threshold, self.limits)
+        self.proc: BaseProcess | None = None
         self._socket = LocalSocket()
+        self._start_lock = Lock()
+        self._idle_task: Task[None] | None = None
+        self._last_call = monotonic()
+        # set once the loader stopped the plugin, as opposed to it being stopped for being idle
+        self._stopped = False
+        # resolved once the current process exits, and whether we are the ones stopping it
+        self._exited: Future[None] | None = None
+        self._stopping = False
+        self.crashed = False
+        # resource usage samples of the process, oldest first, and the limit it was killed for
+        self.stats: Deque[Dict[str, Any]] = deque(maxlen=STATS_HISTORY)
+        self.limit_violation: str | None = None
+        self._stats_task: Task[None] | None = None
         self._listener_task: Task[Any]
         self._method_call_requests: Dict[str, MethodCallRequest] = {}
+        # depth of the sandboxed plugin's call queue, as reported with its latest response
+        self.queued_calls = 0
+        # seconds it took the loader to set up and start the plugin
+        self.load_time: float | None = None
 
         self.emitted_event_callback: EmittedEventCallbackType = emit_callback
+        self.crash_callback = crash_callback
 
         # TODO enable this after websocket release
         self.legacy_method_warning = False
@@ -78,6 +163,10 @@ class PluginWrapper:
         mkdir_as_user(path.join(home, "logs"))
         mkdir_as_user(path.join(home, "logs", self.plugin_directory))
 
+    def refresh_dist_hashes(self):
+        self.dist_hashes = hash_directory(path.join(self.plugin_path, self.plugin_directory, "dist"))
+        self.dist_hash = combine_hashes(self.dist_hashes)
+
     def __str__(self) -> str:
         return self.name
     
@@ -88,82 +177,317 @@ class PluginWrapper:
 
         return self.name
 
+    def get_metrics(self) -> Dict[str, Any]:
+        return {
+            "pending_calls": len(self._method_call_requests),
+            "queued_calls": self.queued_calls,
+            "load_time": self.load_time,
+            "running": self.proc is not None and self.proc.is_alive(),
+        }
+
     async def _response_listener(self):
         while self._socket.active:
             try:
-                line = await self._socket.read_single_line()
-                if line != None:
-                    res = loads(line)
+                message = await self._socket.read_message()
+                if message is None or (not message and self._socket.at_eof()):
+                    # the process is gone (reading at EOF returns right away), the exit watcher reports it
+                    self.log.debug(f"Socket of {self.get_display_name()} was closed, stopping its response listener")
+                    await self._socket.close_socket_connection()
+                    return
+                if message:
+                    res = self._codec.loads(message)
                     if res["type"] == SocketMessageType.EVENT.value:
                         create_task(self.emitted_event_callback(res["event"], res["args"]))
                     elif res["type"] == SocketMessageType.RESPONSE.value:
-                        self._method_call_requests.pop(res["id"]).set_result(res)
+                        self.queued_calls = res.get("queued", 0)
+                        if res.get("trace"):
+                            res["trace"]["replied"] = monotonic()
+                        # the request is gone if the call already timed out or was cancelled
+                        request = self._method_call_requests.get(res["id"])
+                        if request and (res.get("partial") or request.stream is not None):
+                            # the listener never waits for a stream's consumer, replies to other calls would wait with it
+                            if not request.add_to_stream(res):
+                                self.log.warning(f"Cancelling stream {res['id']} of {self.get_display_name()}, its consumer fell {STREAM_BUFFER_SIZE} chunks behind")
+                                self._method_call_requests.pop(res["id"], None)
+                                request.cancel(StreamOverflow(f"Stream fell more than {STREAM_BUFFER_SIZE} chunks behind"))
+                                discard_result(res)
+                                create_task(self._cancel_call(res["id"]))
+                        elif request:
+                            self._method_call_requests.pop(res["id"], None)
+                            request.set_result(res)
+                        else:
+                            # the segment would stay in /dev/shm until reboot
+                            discard_result(res)
             except CancelledError:
                 self.log.info(f"Stopping response listener for {self.get_display_name()}")
                 await self._socket.close_socket_connection()
-
-                # Cancel the request so that WSRouter can perform cleanup
-                for request in self._method_call_requests.values():
-                    request.cancel()
-                
-                self._method_call_requests = {}
                 raise
+            except FrameTooLarge as e:
+                # the socket is out of sync, the exit watcher reports the killed process as a crash and restarts it
+                self.log.error(f"Killing {self.get_display_name()}, it sent a broken message: {e}")
+                await self._socket.close_socket_connection()
+                if self.proc:
+                    self.proc.kill()
+                return
             except:
                 pass
 
-    async def execute_legacy_method(self, method_name: str, kwargs: Dict[Any, Any]):
+    async def execute_legacy_method(self, method_name: str, kwargs: Dict[Any, Any], timeout: float | None = None):
         if not self.legacy_method_warning:
             self.legacy_method_warning = True
             self.log.warning(f"Plugin {self.get_display_name()} is using legacy method calls. This will be removed in a future release.")
         if self.passive:
             raise RuntimeError("This plugin is passive (aka does not implement main.py)")
         
-        request = MethodCallRequest()
-        await self._socket.get_socket_connection()
-        await self._socket.write_single_line(dumps({ "type": SocketMessageType.CALL, "method": method_name, "args": kwargs, "id": request.id, "legacy": True }, ensure_ascii=False))
-        self._method_call_requests[request.id] = request
-
-        return await request.wait_for_result()
+        await self._ensure_started()
+        return await self._call({ "method": method_name, "args": kwargs, "legacy": True }, timeout)
 
-    async def execute_method(self, method_name: str, *args: List[Any]):
+    async def execute_method(self, method_name: str, *args: List[Any], timeout: float | None = None):
         if self.passive:
             raise RuntimeError("This plugin is passive (aka does not implement main.py)")
-        
+
+        await self._ensure_started()
+        return await self._call({ "method": method_name, "args": args }, timeout)
+
+    async def _call(self, call: Dict[str, Any], timeout: float | None):
+        if self.crashed:
+            raise PluginCrashed(f"Plugin {self.get_display_name()} has crashed")
+        if timeout is None:
+            timeout = get_method_call_timeout()
+        deadline = monotonic() + timeout
+
         request = MethodCallRequest()
-        await self._socket.get_socket_connection()
-        await self._socket.write_single_line(dumps({ "type": SocketMessageType.CALL, "method": method_name, "args": args, "id": request.id }, ensure_ascii=False))
+        # register the request before writing it, so even an immediate response finds it
         self._method_call_requests[request.id] = request
-
-        return await request.wait_for_result()
+        streaming = False
+        trace = current_trace.get()
+        try:
+            await self._socket.get_socket_connection()
+            written = monotonic()
+            # the remaining time is forwarded so the sandboxed plugin can cancel the method once nobody waits for it anymore
+            await self._socket.write_message(self._codec.dumps({ **call, "type": SocketMessageType.CALL, "id": request.id, "timeout": max(deadline - monotonic(), 0),
+                                                                 "trace": trace is not None }))
+            if trace:
+                trace.add_span("socket_write", written, monotonic())
+                written = monotonic()
+            result = await request.wait_for_result(max(deadline - monotonic(), 0))
+            if trace and request.timings:
+                self._add_plugin_spans(trace, written, request.timings)
+            if request.stream is not None:
+                # async generator method, the request stays registered until the stream has been consumed
+                streaming = True
+                return self._stream(request, timeout)
+            return result
+        except CancelledError:
+            # the caller went away, tell the sandboxed plugin to stop working on the call
+            # and drop a result that may have arrived in the meantime
+            request.cancel()
+            if self._socket.active:
+                create_task(self._cancel_call(request.id))
+            raise
+        finally:
+            if not streaming:
+                self._method_call_requests.pop(request.id, None)
+
+    def _add_plugin_spans(self, trace: Trace, written: float, timings: Dict[str, float]):
+        pid = self.proc.pid if self.proc else None
+        trace.add_span("socket_transit", written, timings["received"], pid)
+        trace.add_span("plugin_queue", timings["received"], timings["started"], pid)
+        trace.add_span("handler", timings["started"], timings["finished"], pid)
+        trace.add_span("reply_read", timings["finished"], timings["replied"])
+
+    async def _stream(self, request: MethodCallRequest, timeout: float) -> AsyncIterator[Any]:
+        finished = False
+        try:
+            async for chunk in request.iter_stream(timeout):
+                yield chunk
+            finished = True
+        finally:
+            self._method_call_requests.pop(request.id, None)
+            # stopped reading early, the plugin can stop producing chunks
+            if not finished:
+                # drops the chunks nobody is going to read
+                request.cancel()
+                if self._socket.active:
+                    create_task(self._cancel_call(request.id))
     
+    async def _cancel_call(self, call_id: str):
+        try:
+            await self._socket.write_message(self._codec.dumps({ "type": SocketMessageType.CANCEL, "id": call_id }))
+        except:
+            pass
+
+    async def _ensure_started(self):
+        self._last_call = monotonic()
+        # a process that is being stopped can't take the call, wait for the stop to finish and start it again
+        if self.proc and not self._stopping:
+            return
+        if self._stopped:
+            raise RuntimeError(f"Plugin {self.get_display_name()} has been stopped")
+        async with self._start_lock:
+            if self._stopped:
+                raise RuntimeError(f"Plugin {self.get_display_name()} has been stopped")
+            if not self.proc:
+                self.log.info(f"Starting {self.get_display_name()} on its first call")
+                self._start_process()
+
+    async def _stop_when_idle(self, idle_timeout: float):
+        while True:
+            await sleep(max(self._last_call + idle_timeout - monotonic(), 1))
+            if self.proc and not self._method_call_requests and monotonic() - self._last_call >= idle_timeout:
+                async with self._start_lock:
+                    # a call may have come in while waiting for the lock
+                    if not self.proc or self._method_call_requests or monotonic() - self._last_call < idle_timeout:
+                        continue
+                    self.log.info(f"Stopping {self.get_display_name()} after {idle_timeout:.0f}s without calls")
+                    await self._stop_process()
+
     def start(self):
         if self.passive:
             return self
-        self.proc = Process(target=self.sandboxed_plugin.initialize, args=[self._socket])
-        self.proc.start()
-        self._listener_task = create_task(self._response_listener())
+        if self.lazy:
+            idle_timeout = get_plugin_idle_timeout()
+            # plugins with a _main task may be doing work in the background, they keep running once started
+            if idle_timeout > 0 and not has_main_task(self.file):
+                self._idle_task = create_task(self._stop_when_idle(idle_timeout))
+            return self
+        self._start_process()
         return self
 
+    def _start_process(self):
+        if not self._socket.active:
+            # the previous process closed this socket on its way out
+            self._socket = LocalSocket()
+        proc: BaseProcess
+        try:
+            # forked from the fork server, the sandboxed plugin drops its privileges itself once it runs.
+            # BaseContext doesn't declare Process, every concrete context has its own BaseProcess subclass there
+            process_class = cast(Type[BaseProcess], getattr(get_process_context(), "Process"))
+            proc = process_class(target=self.sandboxed_plugin.initialize, args=[self._socket])
+            proc.start()
+        except Exception as e:
+            self.log.warning(f"Could not start {self.get_display_name()} through {get_process_context().get_start_method()}, using the default start method: {e}")
+            proc = Process(target=self.sandboxed_plugin.initialize, args=[self._socket])
+            proc.start()
+        self.proc = proc
+        self._socket.server_started()
+        self.crashed = False
+        self.limit_violation = None
+        self._watch_exit(proc)
+        if get_plugin_stats_interval() > 0:
+            self._stats_task = create_task(self._sample_stats(proc, get_plugin_stats_interval()))
+        self._listener_task = create_task(self._response_listener())
+
+    def _watch_exit(self, proc: BaseProcess):
+        # the sentinel becomes readable once the process exits, so the event loop tells us right away instead of us polling
+        loop = get_event_loop()
+        exited: Future[None] = loop.create_future()
+        self._exited = exited
+
+        def on_exit():
+            if exited.done():
+                return
+            proc.join() # reaps the process, it has already exited
+            exited.set_result(None)
+            self._on_exit(proc)
+
+        def on_sentinel():
+            loop.remove_reader(proc.sentinel)
+            on_exit()
+
+        try:
+            loop.add_reader(proc.sentinel, on_sentinel)
+        except NotImplementedError:
+            # the proactor loop on windows can't watch process handles, wait for the process in a thread instead
+            create_task(to_thread(proc.join)).add_done_callback(lambda _: on_exit())
+
+    async def _sample_stats(self, proc: BaseProcess, interval: float):
+        last_cpu_time: Tuple[float, float] | None = None
+        violations = 0
+        while proc is self.proc and proc.pid is not None:
+            # reading /proc blocks on the filesystem, keep it off the event loop
+            stats = await to_thread(get_process_stats, proc.pid)
+            if stats is None:
+                return
+            now = monotonic()
+            cpu_percent = (stats["cpu_time"] - last_cpu_time[1]) / (now - last_cpu_time[0]) * 100 if last_cpu_time else 0.0
+            last_cpu_time = (now, stats["cpu_time"])
+            self.stats.append({"time": time(), "cpu_percent": round(cpu_percent, 1), "rss": int(stats["rss"]),
+                               "fds": int(stats["fds"]), "threads": int(stats["threads"])})
+
+            violation = self._check_limits(cpu_percent, stats["rss"])
+            violations = violations + 1 if violation else 0
+            if violation and violations >= LIMIT_VIOLATIONS_BEFORE_KILL:
+                self.log.error(f"Killing {self.get_display_name()}, {violation}")
+                self.limit_violation = violation
+                # reported and restarted like any other crash
+                proc.kill()
+                return
+            await sleep(interval)
+
+    def _check_limits(self, cpu_percent: float, rss: float) -> str | None:
+        if "max_rss" in self.limits and rss > self.limits["max_rss"]:
+            return f"it uses {rss / 2**20:.0f} MiB of memory, more than its limit of {self.limits['max_rss'] / 2**20:.0f} MiB"
+        if "max_cpu_percent" in self.limits and cpu_percent > self.limits["max_cpu_percent"]:
+            return f"it uses {cpu_percent:.0f}% CPU, more than its limit of {self.limits['max_cpu_percent']}%"
+        return None
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {"samples": list(self.stats), "limits": self.limits, "limit_violation": self.limit_violation}
+
+    def _on_exit(self, proc: BaseProcess):
+        if proc is not self.proc or self._stopping:
+            return
+        self.crashed = True
+        # the sandboxed plugin exits cleanly if it fails to start, which another start would only repeat
+        failed_to_start = proc.exitcode == 0
+        if failed_to_start:
+            self.log.error(f"Plugin {self.get_display_name()} failed to start, not restarting it")
+        else:
+            self.log.error(f"Plugin {self.get_display_name()} exited unexpectedly with code {proc.exitcode}")
+        # nobody is going to answer the pending calls, fail them now rather than letting them time out
+        for request in self._method_call_requests.values():
+            request.cancel(PluginCrashed(f"Plugin {self.get_display_name()} exited with code {proc.exitcode}"))
+        self._method_call_requests = {}
+        if hasattr(self, "_listener_task"):
+            self._listener_task.cancel()
+        if self.crash_callback and not failed_to_start:
+            create_task(self.crash_callback(self))
+
+    async def restart(self):
+        """Starts the backend of a crashed plugin again."""
+        async with self._start_lock:
+            if not self.crashed or self._stopped:
+                return
+            # the listener of the crashed process still has to close its socket
+            await wait([self._listener_task])
+            self.log.info(f"Restarting {self.get_display_name()}")
+            self._start_process()
+
     async def stop(self, uninstall: bool = False):
         try:
             start_time = time()
             if self.passive:
                 return
+            if self._idle_task:
+                self._idle_task.cancel()
+            if not self.proc:
+                if not uninstall:
+                    self._stopped = True
+                    return
+                # give a lazy backend that never ran the chance to clean up after itself
+                await self._ensure_started()
+            self._stopped = True
             self.log.info(f"Shutting down {self.get_display_name()}")
 
             pending: set[Task[None]] | None = None;
 
             if uninstall:
                 _, pending = await wait([
-                    create_task(self._socket.write_single_line(dumps({ "uninstall": uninstall }, ensure_ascii=False)))
+                    create_task(self._socket.write_message(self._codec.dumps({ "uninstall": uninstall })))
                 ], timeout=1)
 
-            self.terminate() # the plugin process will handle SIGTERM and shut down cleanly without a socket message
-
-            if hasattr(self, "_listener_task"):
-                self._listener_task.cancel()
-            
-            await self.kill_if_still_running()
+            await self._stop_process()
 
             if pending:
                 for pending_task in pending:
@@ -173,14 +497,35 @@ class PluginWrapper:
         except Exception as e:
             self.log.error(f"Error during shutdown for plugin {self.get_display_name()}: {str(e)}\n{format_exc()}")
 
+    async def _stop_process(self):
+        self._stopping = True
+        if self._stats_task:
+            self._stats_task.cancel()
+        self.terminate() # the plugin process will handle SIGTERM and shut down cleanly without a socket message
+
+        if hasattr(self, "_listener_task"):
+            self._listener_task.cancel()
+
+        await self.kill_if_still_running()
+        if hasattr(self, "_listener_task"):
+            # the listener closes the socket on its way out
+            await wait([self._listener_task])
+        # Cancel the requests so that WSRouter can perform cleanup
+        for request in self._method_call_requests.values():
+            request.cancel()
+        self._method_call_requests = {}
+        self.proc = None
+        self._stopping = False
+
     async def kill_if_still_running(self):
-        start_time = time()
-        while self.proc and self.proc.is_alive():
-            elapsed_time = time() - start_time
-            if elapsed_time >= 5:
-                self.log.warning(f"Plugin {self.get_display_name()} still alive 5 seconds after stop request! Sending SIGKILL!")
-                self.terminate(True)
-            await sleep(0.1)
+        if not self.proc or not self._exited:
+            return
+        try:
+            await wait_for(shield(self._exited), 5)
+        except TimeoutError:
+            self.log.warning(f"Plugin {self.get_display_name()} still alive 5 seconds after stop request! Sending SIGKILL!")
+            self.terminate(True)
+            await self._exited
 
 
     def terminate(self, kill: bool = False):
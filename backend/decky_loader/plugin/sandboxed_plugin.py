@@ -1,22 +1,26 @@
 import sys
 from os import path, environ
 from importlib.util import module_from_spec, spec_from_file_location
-from json import dumps, loads
+from inspect import isasyncgen
 from logging import getLogger
 from traceback import format_exc
-from asyncio import (ensure_future, get_event_loop, new_event_loop,
-                     set_event_loop)
+from time import monotonic
+from asyncio import (Future, TimeoutError, ensure_future, get_event_loop, new_event_loop,
+                     set_event_loop, wait_for)
 from signal import SIGINT, SIGTERM
 from setproctitle import setproctitle, setthreadtitle
 
 from .messages import SocketResponseDict, SocketMessageType
-from ..localplatform.localsocket import LocalSocket
-from ..localplatform.localplatform import setgid, setuid, get_username, get_home_path, ON_LINUX
+from .codec import get_codec
+from .shared_blob import BlobData, write_shared_blob
+from .scheduler import CallScheduler, DEFAULT_MAX_IN_FLIGHT, DEFAULT_MAX_QUEUED
+from ..localplatform.localsocket import MAX_FRAME_SIZE, FrameTooLarge, LocalSocket
+from ..localplatform.localplatform import setgid, setuid, get_username, get_home_path, set_process_limits, ON_LINUX
 from ..enums import UserType
 from .. import helpers
 from .. import settings # pyright: ignore [reportUnusedImport]
 
-from typing import List, TypeVar, Any
+from typing import AsyncGenerator, Dict, List, TypeVar, Any, cast
 
 DataType = TypeVar("DataType")
 
@@ -30,7 +34,11 @@ class SandboxedPlugin:
                  plugin_path: str,
                  version: str|None,
                  author: str,
-                 api_version: int) -> None:
+                 api_version: int,
+                 codec: str,
+                 concurrency: Dict[str, Any],
+                 shared_memory_threshold: int | None,
+                 limits: Dict[str, Any]) -> None:
         self.name = name
         self.passive = passive
         self.flags = flags
@@ -40,8 +48,18 @@ class SandboxedPlugin:
         self.version = version
         self.author = author
         self.api_version = api_version
+        self.codec = get_codec(codec)
+        # limits from the "concurrency" section of plugin.json
+        self.scheduler = CallScheduler(self._handle_call,
+                                       concurrency.get("max_in_flight", DEFAULT_MAX_IN_FLIGHT),
+                                       concurrency.get("max_queued", DEFAULT_MAX_QUEUED),
+                                       concurrency.get("methods", {}))
+        # bytes results of at least this size are returned through shared memory
+        self.shared_memory_threshold = shared_memory_threshold
+        self.limits = limits
         self.shutdown_running = False
         self.uninstalling = False
+        self._waiting_submit: Future[None] | None = None
 
         self.log = getLogger("sandboxed_plugin")
 
@@ -69,6 +87,8 @@ class SandboxedPlugin:
             if self.passive:
                 return
                 
+            # set while still privileged, so the plugin can't raise them again
+            set_process_limits(self.limits.get("max_address_space"), self.limits.get("max_open_files"))
             setgid(UserType.EFFECTIVE_USER if "root" in self.flags else UserType.HOST_USER)
             setuid(UserType.EFFECTIVE_USER if "root" in self.flags else UserType.HOST_USER)
             # export a bunch of environment variables to help plugin developers
@@ -97,7 +117,7 @@ class SandboxedPlugin:
             
             from .imports import decky
             async def emit(event: str, *args: Any) -> None:
-                await self._socket.write_single_line_server(dumps({
+                await self._socket.write_message_server(self.codec.dumps({
                     "type": SocketMessageType.EVENT,
                     "event": event,
                     "args": args
@@ -130,7 +150,7 @@ class SandboxedPlugin:
                     get_event_loop().create_task(self.Plugin._main())
                 else:
                     get_event_loop().create_task(self.Plugin._main(self.Plugin))
-            get_event_loop().create_task(socket.setup_server(self.on_new_message))
+            get_event_loop().create_task(self._serve())
         except:
             self.log.error(f"Failed to start {self.get_display_name()}!\n{format_exc()}")
             sys.exit(0)
@@ -143,6 +163,10 @@ class SandboxedPlugin:
         finally:
             get_event_loop().close()
 
+    async def _serve(self):
+        self.scheduler.start()
+        await self._socket.setup_server(self.on_new_message)
+
     async def _unload(self):
         try:
             self.log.info(f"Attempting to unload with plugin {self.get_display_name()}'s \"_unload\" function.\n")
@@ -189,27 +213,98 @@ class SandboxedPlugin:
         loop.call_soon_threadsafe(loop.stop)
         sys.exit(0)
 
-    async def on_new_message(self, message : str) -> str|None:
-        data = loads(message)
+    async def on_new_message(self, message : bytes) -> bytes|None:
+        data = self.codec.loads(message)
 
         if "uninstall" in data:
             self.uninstalling = data.get("uninstall")
             return
 
-        d: SocketResponseDict = {"type": SocketMessageType.RESPONSE, "res": None, "success": True, "id": data["id"]}
+        if data["type"] == SocketMessageType.CANCEL:
+            self.scheduler.cancel(data["id"])
+            return
+
+        # the loader sends the time it is willing to wait, turn it into a deadline before the call gets queued
+        data["deadline"] = monotonic() + data["timeout"] if data.get("timeout") is not None else None
+        if data.get("trace"):
+            data["received"] = monotonic()
+
+        # one call at a time may wait for room in the full queue while the socket is still read, so cancels
+        # (which free up room) get through. Further calls are only read once that call made it into the queue
+        if self._waiting_submit:
+            await self._waiting_submit
+        if self.scheduler.full:
+            self._waiting_submit = ensure_future(self.scheduler.submit(data))
+        else:
+            await self.scheduler.submit(data)
+
+    async def _handle_call(self, data: Dict[str, Any]):
+        timeout = data["deadline"] - monotonic() if data.get("deadline") is not None else None
+        if timeout is not None and timeout <= 0:
+            self.log.debug(f"Skipping call {data['id']} to {data['method']}, the loader stopped waiting for it while it was queued")
+            return
+
+        started = monotonic()
+        d: SocketResponseDict = {"type": SocketMessageType.RESPONSE, "res": None, "success": True, "id": data["id"], "queued": 0, "partial": False, "blob": False, "trace": None}
         try:
             if data.get("legacy"):
                 if self.api_version > 0:
                     raise Exception("Legacy methods may not be used on api_version > 0")
                 # Legacy kwargs
-                d["res"] = await getattr(self.Plugin, data["method"])(self.Plugin, **data["args"])
+                d["res"] = await wait_for(getattr(self.Plugin, data["method"])(self.Plugin, **data["args"]), timeout)
             else:
                 if self.api_version < 1 :
                     raise Exception("api_version 1 or newer is required to call methods with index-based arguments")
                 # New args
-                d["res"] = await getattr(self.Plugin, data["method"])(*data["args"])
+                result = getattr(self.Plugin, data["method"])(*data["args"])
+                if isasyncgen(result):
+                    await self._stream_results(d, data, cast(AsyncGenerator[Any, None], result))
+                else:
+                    d["res"] = await wait_for(result, timeout)
+        except TimeoutError as e:
+            if data["deadline"] is None or monotonic() < data["deadline"]:
+                # raised by the method itself
+                d["res"] = str(e)
+                d["success"] = False
+            else:
+                # wait_for cancelled the method, the loader has already reported the timeout to the frontend
+                self.log.warning(f"Call to {data['method']} of {self.get_display_name()} timed out after {data['timeout']:.1f}s and was cancelled")
+                return
         except Exception as e:
             d["res"] = str(e)
             d["success"] = False
+
+        if data.get("trace"):
+            d["trace"] = {"received": data["received"], "started": started, "finished": monotonic()}
+        await self._respond(d)
+
+    async def _respond(self, d: SocketResponseDict):
+        d["queued"] = self.scheduler.queue_depth
+        try:
+            if self.shared_memory_threshold is not None and d["success"] and isinstance(d["res"], (bytes, bytearray, memoryview)):
+                data = cast(BlobData, d["res"])
+                if len(data) >= self.shared_memory_threshold:
+                    d = {**d, "res": write_shared_blob(data), "blob": True}
+            response = self.codec.dumps(d)
+            if len(response) > MAX_FRAME_SIZE:
+                raise FrameTooLarge(f"the result takes {len(response)} bytes, more than the limit of {MAX_FRAME_SIZE} bytes")
+        except Exception as e:
+            # the result could not be serialized, report that back instead of never answering the call
+            response = self.codec.dumps({**d, "res": f"Failed to serialize result: {e}", "success": False, "partial": False})
+        await self._socket.write_message_server(response)
+
+    async def _stream_results(self, d: SocketResponseDict, data: Dict[str, Any], results: AsyncGenerator[Any, None]):
+        # every chunk is sent as a partial response, the final response (with no result) follows once the generator is done.
+        # for streams the deadline applies to the wait for each chunk rather than to the whole call
+        try:
+            while True:
+                timeout = data["deadline"] - monotonic() if data["deadline"] is not None else None
+                try:
+                    chunk = await wait_for(results.__anext__(), timeout)
+                except StopAsyncIteration:
+                    break
+                await self._respond({**d, "res": chunk, "partial": True})
+                if data["deadline"] is not None:
+                    data["deadline"] = monotonic() + data["timeout"]
         finally:
-            return dumps(d, ensure_ascii=False)
+            await results.aclose()
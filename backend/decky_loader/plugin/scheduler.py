@@ -0,0 +1,126 @@
+from asyncio import Event, Task, create_task
+from collections import deque
+from logging import getLogger
+from typing import Any, Callable, Coroutine, Deque, Dict, Set
+
+DEFAULT_MAX_IN_FLIGHT = 32
+DEFAULT_MAX_QUEUED = 256
+
+CallHandler = Callable[[Dict[str, Any]], Coroutine[Any, Any, Any]]
+
+class CallScheduler:
+    '''
+    Runs method calls for a sandboxed plugin with a bounded number of calls in flight.
+
+    Calls wait in a bounded queue, submit blocks once it is full. As the socket listener awaits submit,
+    the loader's writes to the socket then stall as well, which pushes back on PluginWrapper instead of
+    piling up coroutines inside the plugin process.
+
+    A call only takes one of the max_in_flight slots once its method is below its own limit, so calls to a
+    rate-limited method wait in the queue without holding up calls to other methods.
+    '''
+    def __init__(self, handler: CallHandler, max_in_flight: int = DEFAULT_MAX_IN_FLIGHT,
+                 max_queued: int = DEFAULT_MAX_QUEUED, method_limits: Dict[str, int] | None = None) -> None:
+        self.handler = handler
+        self.max_in_flight = max(1, max_in_flight)
+        self.max_queued = max(1, max_queued)
+        self.method_limits = {method: max(1, limit) for method, limit in (method_limits or {}).items()}
+        self.log = getLogger("scheduler")
+
+        # queued calls in arrival order
+        self._queue: Deque[Dict[str, Any]] = deque()
+        self._not_full: Event | None = None
+        self._saturated = False
+        # running calls per limited method, the tasks of running calls, and the ids of calls still waiting in submit
+        self._method_running: Dict[str, int] = {}
+        self._running: Dict[str, Task[Any]] = {}
+        self._submitting: Set[str] = set()
+        self._cancelled: Set[str] = set()
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._queue)
+
+    @property
+    def full(self) -> bool:
+        return len(self._queue) >= self.max_queued
+
+    def start(self):
+        # created here rather than in __init__ so it belongs to the sandboxed process' event loop
+        self._not_full = Event()
+        self._not_full.set()
+
+    async def submit(self, call: Dict[str, Any]):
+        assert self._not_full
+        self._submitting.add(call["id"])
+        try:
+            while self.full:
+                if not self._saturated:
+                    self._saturated = True
+                    self.log.warning(f"Call queue is full ({self.max_queued} calls), waiting before reading further calls")
+                self._not_full.clear()
+                await self._not_full.wait()
+        finally:
+            self._submitting.discard(call["id"])
+        if len(self._queue) <= self.max_queued // 2:
+            self._saturated = False
+
+        if call["id"] in self._cancelled:
+            # cancelled while it was waiting for room in the queue
+            self._cancelled.discard(call["id"])
+            return
+        self._queue.append(call)
+        self._dispatch()
+
+    def cancel(self, call_id: str):
+        if call_id in self._running:
+            self._running[call_id].cancel()
+        elif call_id in self._submitting:
+            self._cancelled.add(call_id)
+        else:
+            for call in self._queue:
+                if call["id"] == call_id:
+                    self._queue.remove(call)
+                    self._on_dequeued()
+                    break
+
+    def _on_dequeued(self):
+        if self._not_full and not self.full:
+            self._not_full.set()
+
+    def _next_call(self) -> Dict[str, Any] | None:
+        # the oldest call whose method is below its limit
+        for call in self._queue:
+            method = call.get("method", "")
+            if method not in self.method_limits or self._method_running.get(method, 0) < self.method_limits[method]:
+                self._queue.remove(call)
+                self._on_dequeued()
+                return call
+        return None
+
+    def _dispatch(self):
+        while len(self._running) < self.max_in_flight:
+            call = self._next_call()
+            if not call:
+                return
+            self._start(call)
+
+    def _start(self, call: Dict[str, Any]):
+        call_id = call["id"]
+        method = call.get("method", "")
+        if method in self.method_limits:
+            self._method_running[method] = self._method_running.get(method, 0) + 1
+
+        # each call gets its own task so it can be cancelled on its own
+        task = create_task(self.handler(call))
+        self._running[call_id] = task
+
+        def on_done(task: Task[Any]):
+            self._running.pop(call_id, None)
+            if method in self.method_limits:
+                self._method_running[method] -= 1
+            if not task.cancelled() and task.exception():
+                self.log.error(f"Unhandled error while running call {call_id}: {task.exception()}")
+            self._dispatch()
+
+        task.add_done_callback(on_done)
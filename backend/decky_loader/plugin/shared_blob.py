@@ -0,0 +1,89 @@
+from asyncio import get_event_loop
+from logging import getLogger
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+from uuid import uuid4
+from typing import Any, Dict, Union
+
+from aiohttp import web
+
+# blobs are sent to the frontend in chunks of this size, so the response never holds more than one extra copy of it
+CHUNK_SIZE = 2 ** 18  # 256 KiB
+
+# results that can be handed over as a shared blob
+BlobData = Union[bytes, bytearray, "memoryview[int]"]
+
+class SharedBlob:
+    '''
+    Bytes a sandboxed plugin returned through shared memory instead of the plugin socket.
+    '''
+    def __init__(self, name: str, size: int) -> None:
+        self.name = name
+        self.size = size
+
+    def unlink(self):
+        try:
+            shm = SharedMemory(self.name)
+            shm.close()
+            shm.unlink()
+        except FileNotFoundError:
+            pass
+
+def write_shared_blob(data: BlobData) -> Dict[str, Any]:
+    '''Copies data into a new shared memory segment, the loader unlinks it once it has been served.'''
+    size = len(data)
+    shm = SharedMemory(create=True, size=max(size, 1))
+    buf = shm.buf
+    assert buf is not None
+    buf[:size] = data
+    # the resource tracker would unlink the segment once this process exits, it belongs to the loader now
+    resource_tracker.unregister(shm._name, "shared_memory") # pyright: ignore [reportAttributeAccessIssue, reportUnknownMemberType, reportUnknownArgumentType]
+    shm.close()
+    return {"name": shm.name, "size": size}
+
+class SharedBlobStore:
+    '''
+    Serves shared blobs to the frontend over HTTP. Every blob can be fetched once, and is unlinked
+    after that or once it has not been fetched for ttl seconds.
+    Bytes that came over the plugin socket (which JSON can't carry to the frontend) are served the same way.
+    '''
+    def __init__(self, ttl: float = 60) -> None:
+        self.ttl = ttl
+        self.blobs: Dict[str, SharedBlob | bytes] = {}
+        self.logger = getLogger("shared_blobs")
+
+    def add(self, blob: SharedBlob | bytes) -> str:
+        token = uuid4().hex
+        self.blobs[token] = blob
+        get_event_loop().call_later(self.ttl, self.discard, token)
+        return f"/shared_blobs/{token}"
+
+    def discard(self, token: str):
+        blob = self.blobs.pop(token, None)
+        if isinstance(blob, SharedBlob):
+            self.logger.debug(f"Shared blob {blob.name} was never fetched, discarding it")
+            blob.unlink()
+
+    async def handle(self, request: web.Request):
+        blob = self.blobs.pop(request.match_info["token"], None)
+        if blob is None:
+            return web.Response(text="Blob not found", status=404)
+        if isinstance(blob, bytes):
+            return web.Response(body=blob, headers={"Cache-Control": "no-store"}, content_type="application/octet-stream")
+
+        shm = SharedMemory(blob.name)
+        # the name is not needed anymore, the memory is freed once it is closed as well
+        shm.unlink()
+        buf = shm.buf
+        assert buf is not None
+        try:
+            response = web.StreamResponse(headers={"Content-Type": "application/octet-stream", "Cache-Control": "no-store"})
+            response.content_length = blob.size
+            await response.prepare(request)
+            for offset in range(0, blob.size, CHUNK_SIZE):
+                # the transport may hold on to what it is given, so it gets a copy of each chunk rather than a view of the segment
+                await response.write(bytes(buf[offset:offset + CHUNK_SIZE]))
+            await response.write_eof()
+            return response
+        finally:
+            shm.close()
@@ -0,0 +1,124 @@
+from collections import deque
+from contextvars import ContextVar
+from os import getpid
+from time import monotonic
+from typing import Any, Deque, Dict, List, Tuple
+
+from .localplatform.localplatform import get_call_tracing
+
+# finished traces kept for the Chrome trace export
+TRACE_HISTORY = 512
+# upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float("inf"))
+
+class Histogram:
+    '''
+    Counts latencies into LATENCY_BUCKETS.
+    '''
+    def __init__(self) -> None:
+        self.buckets = [0] * len(LATENCY_BUCKETS)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        for index, bound in enumerate(LATENCY_BUCKETS):
+            if value <= bound:
+                self.buckets[index] += 1
+                break
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "buckets": {("+Inf" if bound == float("inf") else str(bound)): count for bound, count in zip(LATENCY_BUCKETS, self.buckets)},
+            "count": self.count,
+            "average": self.total / self.count if self.count else 0,
+            "max": self.max,
+        }
+
+class Trace:
+    '''
+    Timings of a single frontend call, identified by the id the frontend gave the call.
+    All timestamps are monotonic(), which uses the same clock in the loader and in the plugin processes.
+    '''
+    def __init__(self, trace_id: int, route: str, received: float) -> None:
+        self.trace_id = trace_id
+        self.route = route
+        self.received = received
+        # (name, start, end, pid)
+        self.spans: List[Tuple[str, float, float, int]] = []
+
+    def add_span(self, name: str, start: float, end: float, pid: int | None = None):
+        self.spans.append((name, start, end, pid or getpid()))
+
+    def span(self, name: str) -> "Span":
+        return Span(self, name)
+
+class Span:
+    '''
+    Adds a span covering the body of a with statement to a trace.
+    '''
+    def __init__(self, trace: Trace | None, name: str) -> None:
+        self.trace = trace
+        self.name = name
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = monotonic()
+        return self
+
+    def __exit__(self, *_: Any):
+        if self.trace:
+            self.trace.add_span(self.name, self.start, monotonic())
+
+# trace of the frontend call that is currently being handled
+current_trace: ContextVar[Trace | None] = ContextVar("current_trace", default=None)
+
+class Tracer:
+    '''
+    Collects finished traces and aggregates them into per-route latency histograms.
+    '''
+    def __init__(self, enabled: bool = True) -> None:
+        self.enabled = enabled
+        self.traces: Deque[Trace] = deque(maxlen=TRACE_HISTORY)
+        # route -> span name -> histogram, the "total" span covers the whole call
+        self.histograms: Dict[str, Dict[str, Histogram]] = {}
+
+    def start(self, trace_id: int, route: str, received: float | None = None) -> Trace | None:
+        if not self.enabled:
+            return None
+        return Trace(trace_id, route, received or monotonic())
+
+    def finish(self, trace: Trace | None):
+        if not trace:
+            return
+        trace.add_span("total", trace.received, monotonic())
+        self.traces.append(trace)
+        histograms = self.histograms.setdefault(trace.route, {})
+        for name, start, end, _ in trace.spans:
+            histograms.setdefault(name, Histogram()).observe(end - start)
+
+    async def get_latencies(self) -> Dict[str, Dict[str, Dict[str, Any]]]:
+        return {route: {name: histogram.to_dict() for name, histogram in spans.items()} for route, spans in self.histograms.items()}
+
+    def export_chrome_trace(self) -> Dict[str, Any]:
+        '''Returns the kept traces in the Chrome trace event format, loadable in chrome://tracing or Perfetto.'''
+        events: List[Dict[str, Any]] = []
+        for trace in self.traces:
+            for name, start, end, pid in trace.spans:
+                events.append({
+                    "name": name,
+                    "cat": trace.route,
+                    "ph": "X",
+                    "ts": start * 1e6,
+                    "dur": (end - start) * 1e6,
+                    "pid": pid,
+                    # one row per call
+                    "tid": trace.trace_id,
+                    "args": {"id": trace.trace_id, "route": trace.route},
+                })
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+tracer = Tracer(get_call_tracing())
@@ -51,6 +51,8 @@ class Updater:
 
         if context:
             context.ws.add_route("updater/get_version_info", self.get_version_info);
+            # only the latest progress matters, and the download emits it many times a second
+            context.ws.coalesce_event("updater/update_download_percentage", 0.1)
             context.ws.add_route("updater/check_for_updates", self.check_for_updates);
             context.ws.add_route("updater/do_restart", self.do_restart);
             context.ws.add_route("updater/do_shutdown", self.do_shutdown);
@@ -1,19 +1,26 @@
 from logging import getLogger
 
-from asyncio import AbstractEventLoop
+from asyncio import AbstractEventLoop, CancelledError, Queue, Task, TimerHandle, TimeoutError, gather, wait_for
+from contextvars import ContextVar
+from json import dumps
+from time import monotonic
 from aiohttp import WSCloseCode, WSMsgType, WSMessage
 from aiohttp.web import Application, WebSocketResponse, Request, Response, get
 
+from collections import OrderedDict
 from enum import IntEnum
-from typing import Callable, Coroutine, Dict, Any, cast
+from inspect import isasyncgen
+from typing import Callable, Coroutine, Dict, Any, List, Set, Tuple, cast
 from traceback import format_exc
 
 from .helpers import get_csrf_token
 from .plugin.messages import PluginStopped
+from .tracing import Span, Trace, current_trace, tracer
 
 class MessageType(IntEnum):
     ERROR = -1
     # Call-reply, Frontend (CALL) -> Backend (REPLY|DISCARD) -> Frontend (RECEIVED_RESPONSE) -> Backend
+    # Streamed results are sent as REPLY messages with partial set, followed by a final REPLY with stream set
     CALL = 0
     REPLY = 1
     DISCARD = 2
@@ -23,6 +30,16 @@ class MessageType(IntEnum):
     FULL_SYNC = 4
     # Pub/Sub, Backend -> Frontend
     EVENT = 5
+    # Frontend (CANCEL) -> Backend, the frontend no longer waits for the call, no reply is sent
+    CANCEL = 6
+    # Several calls in one message. Each reply is sent as soon as its call finishes, the BATCH_REPLY follows once
+    # all of them did and is the only one acknowledged. After a reconnect it carries every reply of the batch,
+    #   Frontend (BATCH) -> Backend (REPLY|ERROR|DISCARD..., BATCH_REPLY) -> Frontend (RECEIVED_RESPONSE) -> Backend
+    BATCH = 7
+    BATCH_REPLY = 8
+    # Frontend (SUBSCRIBE|UNSUBSCRIBE) -> Backend, once subscribed only the subscribed events are sent
+    SUBSCRIBE = 9
+    UNSUBSCRIBE = 10
 
 # WSMessage with slightly better typings
 class WSMessageExtra(WSMessage):
@@ -34,48 +51,275 @@ class WSMessageExtra(WSMessage):
 
 Route = Callable[..., Coroutine[Any, Any, Any]]
 
+class PendingResponseStore:
+    '''
+    Keeps the replies the frontend has not acknowledged yet, so they can be replayed after a reconnect.
+
+    Calls still waiting for their reply are always kept. Replies are evicted, oldest first, once they are
+    older than max_age seconds or once the store holds more than max_size of them.
+    '''
+    def __init__(self, max_size: int = 1024, max_age: float = 300) -> None:
+        self.max_size = max_size
+        self.max_age = max_age
+        # call id -> (monotonic() time the reply was stored, reply), in the order the calls were received
+        self._entries: OrderedDict[int, Tuple[float, Dict[str, Any] | None]] = OrderedDict()
+        self._replies = 0
+        self.evicted = 0
+        self.acknowledged = 0
+
+    def __contains__(self, call_id: int) -> bool:
+        return call_id in self._entries
+
+    def ids(self) -> List[int]:
+        return list(self._entries.keys())
+
+    def get(self, call_id: int) -> Dict[str, Any] | None:
+        entry = self._entries.get(call_id)
+        return entry[1] if entry else None
+
+    def track(self, call_id: int):
+        self._entries[call_id] = (monotonic(), None)
+
+    def store(self, call_id: int, reply: Dict[str, Any]):
+        if self._entries[call_id][1] is None:
+            self._replies += 1
+        self._entries[call_id] = (monotonic(), reply)
+        self._evict()
+
+    def pop(self, call_id: int):
+        entry = self._entries.pop(call_id, None)
+        if entry and entry[1] is not None:
+            self._replies -= 1
+
+    def acknowledge(self, call_id: int):
+        if call_id in self._entries:
+            self.acknowledged += 1
+        self.pop(call_id)
+
+    def acknowledge_up_to(self, call_id: int):
+        # calls still waiting for their reply stay, their reply has not been sent yet
+        for acked_id in [i for i, (_, reply) in self._entries.items() if i <= call_id and reply is not None]:
+            self.acknowledge(acked_id)
+
+    def _evict(self):
+        expired = monotonic() - self.max_age
+        for call_id, (stored, reply) in list(self._entries.items()):
+            if reply is None:
+                continue
+            if self._replies <= self.max_size and stored > expired:
+                break
+            self.pop(call_id)
+            self.evicted += 1
+
+    def get_metrics(self) -> Dict[str, Any]:
+        return {
+            "pending": len(self._entries) - self._replies,
+            "unacknowledged": self._replies,
+            "acknowledged": self.acknowledged,
+            "evicted": self.evicted,
+        }
+
+# the frontend accepts a JSON array of messages in a single frame
+MAX_MESSAGES_PER_FRAME = 64
+# messages queued for the frontend before writers have to wait
+OUTBOX_HIGH_WATER_MARK = 1024
+
+# monotonic() deadline of the frontend call a route is handling, if the frontend set a timeout for it
+call_deadline: ContextVar[float | None] = ContextVar("call_deadline", default=None)
+
 class WSRouter:
     def __init__(self, loop: AbstractEventLoop, server_instance: Application) -> None:
         self.loop = loop
         self.ws: WebSocketResponse | None = None
         self.routes: Dict[str, Route]  = {}
-        self.pending_responses: Dict[int, Dict[str, Any] | None] = {}
+        self.pending_responses = PendingResponseStore()
+        self.running_calls: Dict[int, Task[None]] = {}
+        # events the frontend listens to, None until it subscribes so frontends without subscriptions get every event
+        self.subscriptions: Set[str] | None = None
+        # minimum seconds between two sends of a coalesced event, and the latest arguments waiting to be sent
+        self.event_intervals: Dict[str, float] = {}
+        self.coalesced_events: Dict[str, Tuple[str, Tuple[Any, ...]]] = {}
+        self.coalesce_timers: Dict[str, TimerHandle] = {}
+        self.events_last_sent: Dict[str, float] = {}
+        # messages waiting for the writer task, with the monotonic() time they were queued at
+        self.outbox: Queue[Tuple[float, Dict[str, Any]]] = Queue(OUTBOX_HIGH_WATER_MARK)
+        self._writer_task: Task[None] | None = None
+        self.sent_messages = 0
+        self.sent_frames = 0
+        self.outbox_latency_total = 0.0
+        self.outbox_latency_max = 0.0
         self.logger = getLogger("WSRouter")
 
         server_instance.add_routes([
             get("/ws", self.handle)
         ])
 
-    async def write(self, data: Dict[str, Any]):
+    async def write(self, data: Dict[str, Any], replay: Dict[str, Any] | None = None):
         # Cache all of the pending responses in case the connection is lost.
         # Cleanup will happen during full-sync or when frontend confirms it has received the message
+        # replay is sent instead of data if the reply has to be sent again after a reconnect
         can_drop_message = True
-        if "id" in data and data["id"] in self.pending_responses:
-            self.pending_responses[data["id"]] = data
+        # chunks of a streamed reply are not replayed after a reconnect, only the final reply is
+        if "id" in data and data["id"] in self.pending_responses and not data.get("partial"):
+            self.pending_responses.store(data["id"], replay or data)
             can_drop_message = False
 
         if self.ws != None:
-            await self.ws.send_json(data)
+            if not self._writer_task:
+                self._writer_task = self.loop.create_task(self._writer())
+            # blocks once the frontend falls too far behind, which slows down whoever is producing messages
+            await self.outbox.put((monotonic(), data))
         elif can_drop_message:
             self.logger.warning("Dropping message as there is no connected socket: %s", data)
 
+    async def _writer(self):
+        while True:
+            messages = [await self.outbox.get()]
+            # everything queued in the meantime goes out in the same frame
+            while not self.outbox.empty() and len(messages) < MAX_MESSAGES_PER_FRAME:
+                messages.append(self.outbox.get_nowait())
+
+            now = monotonic()
+            for queued, _ in messages:
+                self.outbox_latency_max = max(self.outbox_latency_max, now - queued)
+                self.outbox_latency_total += now - queued
+            self.sent_messages += len(messages)
+            self.sent_frames += 1
+
+            if self.ws == None:
+                for _, data in messages:
+                    self.logger.warning("Dropping message as there is no connected socket: %s", data)
+                continue
+            # serialized one by one, so a message that can't be serialized doesn't take the rest of the frame with it
+            serialized = [self._serialize(data) for _, data in messages]
+            serialized = [message for message in serialized if message is not None]
+            if not serialized:
+                continue
+            try:
+                await self.ws.send_str(serialized[0] if len(serialized) == 1 else f"[{','.join(serialized)}]")
+            except Exception as e:
+                self.logger.error(f"Failed to send {len(serialized)} messages: {e}")
+
+    def _serialize(self, data: Dict[str, Any]) -> str | None:
+        try:
+            return dumps(data)
+        except Exception as e:
+            self.logger.error(f"Failed to serialize message {data.get('type')} {data.get('id', '')}: {e}")
+            if data.get("type") == MessageType.BATCH_REPLY.value:
+                replies = [reply for reply in (self._serialize(reply) for reply in data["replies"]) if reply is not None]
+                return f'{{"type": {MessageType.BATCH_REPLY.value}, "id": {dumps(data["id"])}, "replies": [{",".join(replies)}]}}'
+            if data.get("type") != MessageType.REPLY.value or "id" not in data:
+                return None
+            # the caller is still waiting, answer with an error instead
+            error = {"name": e.__class__.__name__, "message": f"Result could not be sent to the frontend: {e}", "traceback": None}
+            reply = {"type": MessageType.ERROR.value, "id": data["id"], "error": error}
+            if data["id"] in self.pending_responses and not data.get("partial"):
+                self.pending_responses.store(data["id"], reply)
+            return dumps(reply)
+
     def add_route(self, name: str, route: Route):
         self.routes[name] = route
 
     def remove_route(self, name: str):
         del self.routes[name]
 
-    async def _call_route(self, route: str, args: ..., call_id: int):
+    async def _call_route(self, route: str, args: ..., call_id: int, timeout: float | None = None, received: float | None = None):
+        trace = tracer.start(call_id, route, received)
+        message = await self._run_route(route, args, call_id, timeout, trace)
+        with Span(trace, "reply_write"):
+            await self.write(message)
+        tracer.finish(trace)
+
+    async def _run_route(self, route: str, args: ..., call_id: int, timeout: float | None = None, trace: Trace | None = None) -> Dict[str, Any]:
+        current_trace.set(trace)
+        if trace:
+            trace.add_span("ws_queue", trace.received, monotonic())
         try:
-            res = await self.routes[route](*args)
-            message = {"type": MessageType.REPLY.value, "id": call_id, "result": res}
+            if timeout is not None:
+                call_deadline.set(monotonic() + timeout)
+            with Span(trace, "dispatch"):
+                res = await wait_for(self.routes[route](*args), timeout)
+            if isasyncgen(res):
+                # relay streamed results chunk by chunk, the final reply marks the end of the stream
+                try:
+                    async for chunk in res:
+                        await self.write({"type": MessageType.REPLY.value, "id": call_id, "result": chunk, "partial": True})
+                finally:
+                    # stops the route's stream right away if the call got cancelled, rather than whenever it is collected
+                    await res.aclose()
+                message = {"type": MessageType.REPLY.value, "id": call_id, "result": None, "stream": True}
+            else:
+                message = {"type": MessageType.REPLY.value, "id": call_id, "result": res}
+        except TimeoutError as err:
+            if timeout is not None:
+                error = {"name": "TimeoutError", "message": f"{route} did not finish within {timeout:.1f}s", "traceback": None}
+            else:
+                # raised by the route itself
+                error = {"name":err.__class__.__name__, "message":str(err), "traceback":format_exc()}
+            message = {"type": MessageType.ERROR.value, "id": call_id, "error": error}
+        except CancelledError:
+            # cancelled by the frontend, nobody is waiting for a reply anymore
+            self.pending_responses.pop(call_id)
+            raise
         except PluginStopped as err:
             message = {"type": MessageType.DISCARD.value, "id": call_id}
         except Exception as err:
             error = {"name":err.__class__.__name__, "message":str(err), "traceback":format_exc()}
             message = {"type": MessageType.ERROR.value, "id": call_id, "error": error}
-        
+
+        return message
+
+    async def _call_batch(self, batch_id: int, calls: List[Dict[str, Any]], received: float | None = None):
+        tasks: List[Task[Dict[str, Any]]] = []
+        traces: List[Trace | None] = []
+        for call in calls:
+            if call["route"] not in self.routes:
+                tasks.append(self.loop.create_task(self._send_reply(self._route_not_found(call["id"], call["route"]))))
+                traces.append(None)
+                continue
+            trace = tracer.start(call["id"], call["route"], received)
+            traces.append(trace)
+            task = self.loop.create_task(self._run_batched_route(call["route"], call["args"], call["id"], self._get_timeout(call), trace))
+            # calls in a batch can be cancelled one by one
+            self._track_call(call["id"], task)
+            tasks.append(task)
+
+        results = await gather(*tasks, return_exceptions=True)
+        # cancelled calls are left out, nobody waits for them
+        replies = [result for result in results if isinstance(result, dict)]
+        for result in results:
+            if isinstance(result, Exception):
+                self.logger.error(f"Batched call failed unexpectedly: {result}")
+
+        # the replies went out already, they are only sent again if the frontend missed them
+        await self.write({"type": MessageType.BATCH_REPLY.value, "id": batch_id, "replies": []},
+                         {"type": MessageType.BATCH_REPLY.value, "id": batch_id, "replies": replies})
+        for trace, result in zip(traces, results):
+            if isinstance(result, dict):
+                tracer.finish(trace)
+
+    async def _run_batched_route(self, route: str, args: ..., call_id: int, timeout: float | None, trace: Trace | None) -> Dict[str, Any]:
+        message = await self._run_route(route, args, call_id, timeout, trace)
+        with Span(trace, "reply_write"):
+            await self.write(message)
+        return message
+
+    async def _send_reply(self, reply: Coroutine[Any, Any, Dict[str, Any]]) -> Dict[str, Any]:
+        message = await reply
         await self.write(message)
+        return message
+
+    async def _route_not_found(self, call_id: int, route: str) -> Dict[str, Any]:
+        error = {"error":f'Route {route} does not exist.', "name": "RouteNotFoundError", "traceback": None}
+        return {"type": MessageType.ERROR.value, "id": call_id, "error": error}
+
+    def _get_timeout(self, data: Dict[str, Any]) -> float | None:
+        # the frontend sends timeouts in milliseconds
+        return data["timeout"] / 1000 if data.get("timeout") is not None else None
+
+    def _track_call(self, call_id: int, task: Task[Any]):
+        self.running_calls[call_id] = task
+        task.add_done_callback(lambda _: self.running_calls.pop(call_id, None))
 
     async def handle(self, request: Request):
         # Auth is a query param as JS WebSocket doesn't support headers
@@ -94,6 +338,7 @@ class WSRouter:
             self.ws = None
 
         self.ws = ws
+        self.subscriptions = None
         
         try:
             async for msg in ws:
@@ -104,14 +349,23 @@ class WSRouter:
                         # TODO DO NOT RELY ON THIS!
                         break
                     else:
+                        received = monotonic()
                         data = msg.json()
                         match data["type"]:
                             case MessageType.CALL.value:
-                                self.handle_call_message(data)
+                                self.handle_call_message(data, received)
                             case MessageType.RECEIVED_RESPONSE.value:
-                                self.handle_received_response_message(data["id"])
+                                self.handle_received_response_message(data)
                             case MessageType.FULL_SYNC.value:
                                 self.handle_full_sync_message(data)
+                            case MessageType.CANCEL.value:
+                                self.handle_cancel_message(data["id"])
+                            case MessageType.BATCH.value:
+                                self.handle_batch_message(data, received)
+                            case MessageType.SUBSCRIBE.value:
+                                self.handle_subscribe_message(data)
+                            case MessageType.UNSUBSCRIBE.value:
+                                self.handle_unsubscribe_message(data)
                             case _:
                                 self.logger.error("Unknown message type", data)
         finally:
@@ -124,44 +378,155 @@ class WSRouter:
         self.logger.debug('Websocket connection closed')
         return ws
 
-    def handle_call_message(self, data: Dict[str, Any]):
-        call_id = data["id"]
+    def _is_known_call(self, call_id: int) -> bool:
         if call_id in self.pending_responses:
-            reply = self.pending_responses[call_id]
+            reply = self.pending_responses.get(call_id)
             if reply:
                 self.logger.debug(f'Found pending PY call matching ID {call_id}. Sending reply...')
                 self.loop.create_task(self.write(reply))
             else:
                 self.logger.debug(f'Found pending PY call matching ID {call_id}. Waiting for reply from plugin...')
 
-            return
-        
+            return True
+
         # Prepare a call entry for caching the reply once we have it, this will also
         # help us identify (above) if we are already handling the call message or not. 
-        self.pending_responses[call_id] = None
+        self.pending_responses.track(call_id)
+        return False
+
+    def handle_call_message(self, data: Dict[str, Any], received: float | None = None):
+        call_id = data["id"]
+        if self._is_known_call(call_id):
+            return
+
         if data["route"] in self.routes:
             self.logger.debug(f'Started PY call {data["route"]} ID {call_id}')
-            self.loop.create_task(self._call_route(data["route"], data["args"], call_id))
+            self._track_call(call_id, self.loop.create_task(self._call_route(data["route"], data["args"], call_id, self._get_timeout(data), received)))
         else:
-            error = {"error":f'Route {data["route"]} does not exist.', "name": "RouteNotFoundError", "traceback": None}
-            self.loop.create_task(self.write({"type": MessageType.ERROR.value, "id": call_id, "error": error}))
+            self.loop.create_task(self._call_route_not_found(call_id, data["route"]))
+
+    async def _call_route_not_found(self, call_id: int, route: str):
+        await self.write(await self._route_not_found(call_id, route))
 
-    def handle_received_response_message(self, call_id: int):
-        self.logger.debug(f'Removing pending response with ID {call_id}')
-        self.pending_responses.pop(call_id, None)
+    def handle_batch_message(self, data: Dict[str, Any], received: float | None = None):
+        batch_id = data["id"]
+        if self._is_known_call(batch_id):
+            return
+
+        self.logger.debug(f'Started batch of {len(data["calls"])} PY calls ID {batch_id}')
+        self._track_call(batch_id, self.loop.create_task(self._call_batch(batch_id, data["calls"], received)))
+
+    def handle_cancel_message(self, call_id: int):
+        task = self.running_calls.get(call_id)
+        if task:
+            self.logger.debug(f'Cancelling PY call with ID {call_id}')
+            task.cancel()
+        else:
+            self.pending_responses.pop(call_id)
+
+    def handle_received_response_message(self, data: Dict[str, Any]):
+        # acknowledges either a single reply, or every reply up to an id plus the ones listed after it
+        if "up_to" in data:
+            self.logger.debug(f'Removing pending responses up to ID {data["up_to"]} and {data.get("ids", [])}')
+            self.pending_responses.acknowledge_up_to(data["up_to"])
+        for call_id in data.get("ids", [data["id"]] if "id" in data else []):
+            self.pending_responses.acknowledge(call_id)
             
     def handle_full_sync_message(self, data: Dict[str, Any]):
         messages = data["messages"]
-        outdated_response_ids = set(self.pending_responses.keys())
+        outdated_response_ids = set(self.pending_responses.ids())
 
         for message in messages:
             outdated_response_ids.discard(message["id"])
-            self.handle_call_message(message)
+            if message["type"] == MessageType.BATCH.value:
+                self.handle_batch_message(message)
+            else:
+                self.handle_call_message(message)
 
+        # the frontend does not know about these calls anymore (e.g. after a JS context restart), stop the ones still running
         for outdated_id in outdated_response_ids:
-            self.handle_received_response_message(outdated_id)
+            self.handle_cancel_message(outdated_id)
+            self.pending_responses.pop(outdated_id)
+
+    def handle_subscribe_message(self, data: Dict[str, Any]):
+        if self.subscriptions is None or data.get("replace"):
+            self.subscriptions = set()
+        self.subscriptions.update(data["events"])
+
+    def handle_unsubscribe_message(self, data: Dict[str, Any]):
+        if self.subscriptions is not None:
+            self.subscriptions.difference_update(data["events"])
+
+    def is_subscribed(self, topic: str) -> bool:
+        return self.subscriptions is None or topic in self.subscriptions
+
+    def coalesce_event(self, topic: str, interval: float):
+        """
+        Sends the topic at most once every interval seconds, the arguments of the latest emit win.
+        """
+        self.event_intervals[topic] = interval
+
+    def remove_coalesced_events(self, prefix: str):
+        """
+        Stops coalescing every topic starting with prefix, e.g. the events of a plugin that is being uninstalled.
+        """
+        for topic in [topic for topic in self.event_intervals if topic.startswith(prefix)]:
+            del self.event_intervals[topic]
+            self.events_last_sent.pop(topic, None)
+            self.coalesced_events.pop(topic, None)
+            timer = self.coalesce_timers.pop(topic, None)
+            if timer:
+                timer.cancel()
+
+    async def get_metrics(self) -> Dict[str, Any]:
+        return {
+            "running_calls": len(self.running_calls),
+            "pending_responses": self.pending_responses.get_metrics(),
+            "outbox": {
+                "queued": self.outbox.qsize(),
+                "sent_messages": self.sent_messages,
+                "sent_frames": self.sent_frames,
+                "average_latency": self.outbox_latency_total / self.sent_messages if self.sent_messages else 0,
+                "max_latency": self.outbox_latency_max,
+            },
+        }
+
+    async def emit(self, event: str, *args: Any, topic: str | None = None):
+        # the topic is what the frontend subscribes to, it defaults to the event name
+        topic = topic or event
+        if not self.is_subscribed(topic):
+            return
+
+        interval = self.event_intervals.get(topic)
+        if interval:
+            scheduled = topic in self.coalesced_events
+            self.coalesced_events[topic] = (event, args)
+            if not scheduled:
+                delay = self.events_last_sent.get(topic, 0) + interval - monotonic()
+                if delay > 0:
+                    self.coalesce_timers[topic] = self.loop.call_later(delay, lambda: self.loop.create_task(self._emit_coalesced(topic)))
+                else:
+                    await self._emit_coalesced(topic)
+            return
+
+        # held back values were emitted first, they must not arrive after this event
+        # (e.g. a last download percentage after the download finished)
+        for pending_topic in list(self.coalesced_events):
+            await self._emit_coalesced(pending_topic)
+        await self._emit(event, args)
+
+    async def _emit_coalesced(self, topic: str):
+        timer = self.coalesce_timers.pop(topic, None)
+        if timer:
+            timer.cancel()
+        pending = self.coalesced_events.pop(topic, None)
+        if not pending:
+            # sent early, before a later event
+            return
+        self.events_last_sent[topic] = monotonic()
+        await self._emit(*pending)
 
-    async def emit(self, event: str, *args: Any):
+    async def _emit(self, event: str, args: Tuple[Any, ...]):
         self.logger.debug(f'Firing frontend event {event} with args {args}')
         await self.write({ "type": MessageType.EVENT.value, "event": event, "args": args })
 
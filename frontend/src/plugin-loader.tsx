@@ -41,6 +41,7 @@ import { getVersionInfo } from './updater';
 import { getPluginDisplayName } from './utils/pluginHelpers';
 import { getSetting, setSetting } from './utils/settings';
 import TranslationHelper, { TranslationClass } from './utils/TranslationHelper';
+import { CallOptions } from './wsrouter';
 
 const StorePage = lazy(() => import('./components/store/Store'));
 const SettingsPage = lazy(() => import('./components/settings'));
@@ -62,9 +63,25 @@ interface DeckyRequestInit extends RequestInit {
   excludedHeaders: string[];
 }
 
-const callPluginMethod = DeckyBackend.callable<[pluginName: string, method: string, ...args: any], any>(
-  'loader/call_plugin_method',
-);
+// Large binary results of plugins opting into shared memory are fetched separately, they can be fetched once
+const resolveSharedBlob = async (result: any) => {
+  if (result?.__decky_shared_blob__ === undefined) return result;
+  const res = await fetch(`http://127.0.0.1:1337${result.__decky_shared_blob__}`, {
+    headers: {
+      'X-Decky-Auth': deckyAuthToken,
+    },
+  });
+  if (!res.ok) throw new Error(`Failed to fetch shared blob: ${res.status} ${res.statusText}`);
+  return res.arrayBuffer();
+};
+
+const callPluginMethod = (pluginName: string, methodName: string, ...args: any) =>
+  DeckyBackend.call<[pluginName: string, method: string, ...args: any], any>(
+    'loader/call_plugin_method',
+    pluginName,
+    methodName,
+    ...args,
+  ).then(resolveSharedBlob);
 
 class PluginLoader extends Logger {
   private plugins: Plugin[] = [];
@@ -81,8 +98,10 @@ class PluginLoader extends Logger {
   public notificationService = new NotificationService(this.deckyState);
 
   private reloadLock: boolean = false;
+  // bundle URLs imported in this JS context, importing one of them again returns the already evaluated module
+  private importedBundles: Set<string> = new Set();
   // stores a list of plugin names which requested to be reloaded
-  private pluginReloadQueue: { name: string; version?: string; loadType: PluginLoadType }[] = [];
+  private pluginReloadQueue: { name: string; version?: string; loadType: PluginLoadType; hash?: string | null }[] = [];
 
   private loaderUpdateToast?: ToastNotification;
   private pluginUpdateToast?: ToastNotification;
@@ -92,8 +111,10 @@ class PluginLoader extends Logger {
 
     DeckyBackend.addEventListener('loader/notify_updates', this.notifyUpdates.bind(this));
     DeckyBackend.addEventListener('loader/import_plugin', this.importPlugin.bind(this));
+    DeckyBackend.addEventListener('loader/reload_frontend', this.reloadPluginFrontend.bind(this));
     DeckyBackend.addEventListener('loader/unload_plugin', this.unloadPlugin.bind(this));
     DeckyBackend.addEventListener('loader/disable_plugin', this.doDisablePlugin.bind(this));
+    DeckyBackend.addEventListener('loader/plugin_crashed', this.pluginCrashed.bind(this));
     DeckyBackend.addEventListener('loader/add_plugin_install_prompt', this.addPluginInstallPrompt.bind(this));
     DeckyBackend.addEventListener(
       'loader/add_multiple_plugins_install_prompt',
@@ -178,7 +199,7 @@ class PluginLoader extends Logger {
 
   private getPluginsFromBackend = DeckyBackend.callable<
     [],
-    { name: string; version: string; load_type: PluginLoadType; disabled: boolean }[]
+    { name: string; version: string; load_type: PluginLoadType; disabled: boolean; hash: string | null }[]
   >('loader/get_plugins');
 
   private restartWebhelper = DeckyBackend.callable<[], void>('utilities/restart_webhelper');
@@ -209,7 +230,7 @@ class PluginLoader extends Logger {
         this.deckyState.setDisabledPlugins(disabledPlugins);
       } else {
         if (!this.hasPlugin(plugin.name))
-          pluginLoadPromises.push(this.importPlugin(plugin.name, plugin.version, plugin.load_type, false));
+          pluginLoadPromises.push(this.importPlugin(plugin.name, plugin.version, plugin.load_type, false, undefined, plugin.hash));
       }
     }
     await Promise.all(pluginLoadPromises);
@@ -389,6 +410,29 @@ class PluginLoader extends Logger {
     this.deckyState.setPlugins(this.plugins);
   }
 
+  public pluginCrashed(name: string, exitCode: number | null, restarting: boolean, limitViolation: string | null) {
+    this.warn(
+      `Backend of ${name} crashed with exit code ${exitCode}, restarting: ${restarting}` +
+        (limitViolation ? `, killed because ${limitViolation}` : ''),
+    );
+    this.toaster.toast({
+      title: (
+        <TranslationHelper
+          transClass={TranslationClass.PLUGIN_LOADER}
+          transText="plugin_crashed.toast"
+          i18nArgs={{ name: name }}
+        />
+      ),
+      body: (
+        <TranslationHelper
+          transClass={TranslationClass.PLUGIN_LOADER}
+          transText={restarting ? 'plugin_crashed.restarting' : 'plugin_crashed.gave_up'}
+        />
+      ),
+      icon: <FaExclamationCircle />,
+    });
+  }
+
   public unloadPlugin(name: string, skipStateUpdate: boolean = false) {
     const plugin = this.plugins.find((plugin) => plugin.name === name);
     plugin?.onDismount?.();
@@ -396,16 +440,65 @@ class PluginLoader extends Logger {
     if (!skipStateUpdate) this.deckyState.setPlugins(this.plugins);
   }
 
+  private getBundleURL(name: string, hash?: string | null) {
+    // the hash only changes with the bundle, so the first import of an unchanged plugin comes straight from CEF's cache.
+    // later imports need a fresh URL, or the module (and its top-level code) isn't evaluated again
+    const url = `http://127.0.0.1:1337/plugins/${name}/dist/index.js`;
+    if (!hash) return `${url}?t=${Date.now()}`;
+    if (this.importedBundles.has(`${url}?v=${hash}`)) return `${url}?v=${hash}&t=${Date.now()}`;
+    this.importedBundles.add(`${url}?v=${hash}`);
+    return `${url}?v=${hash}`;
+  }
+
+  public async reloadPluginFrontend(
+    name: string,
+    version: string | undefined,
+    loadType: PluginLoadType,
+    hash: string | null,
+  ) {
+    // the fallback below would load the UI of a plugin the user disabled
+    if (this.deckyState.publicState().disabledPlugins.some((plugin) => plugin.name === name)) return;
+    // legacy plugins get an API object bound to their instance, they (and anything racing a full import) take the slow path
+    if (
+      this.reloadLock ||
+      !hash ||
+      loadType !== PluginLoadType.ESMODULE_V1 ||
+      !this.plugins.some((plugin) => plugin.name === name)
+    ) {
+      return this.importPlugin(name, version, loadType, true, undefined, hash);
+    }
+
+    let dismounted = false;
+    try {
+      const startTime = performance.now();
+      const pluginExports = await import(this.getBundleURL(name, hash));
+      // the old module stays in place until the new one has been evaluated, so a broken bundle leaves it working
+      const index = this.plugins.findIndex((plugin) => plugin.name === name);
+      dismounted = true;
+      this.plugins[index]?.onDismount?.();
+      const plugin = pluginExports.default();
+      const reloaded = { ...plugin, name, version, loadType };
+      this.plugins = index === -1 ? [...this.plugins, reloaded] : this.plugins.map((p, i) => (i === index ? reloaded : p));
+      this.deckyState.setPlugins(this.plugins);
+      this.log(`Reloaded the frontend of ${getPluginDisplayName(name, version)} in ${performance.now() - startTime}ms`);
+    } catch (e) {
+      this.error(`Error reloading the frontend of ${getPluginDisplayName(name, version)}`, e);
+      // the old instance is gone already, a full import shows the error in its place
+      if (dismounted) return this.importPlugin(name, version, loadType, true, undefined, hash);
+    }
+  }
+
   public async importPlugin(
     name: string,
     version?: string | undefined,
     loadType: PluginLoadType = PluginLoadType.ESMODULE_V1,
     useQueue: boolean = true,
     timeoutMS?: number,
+    hash?: string | null,
   ) {
     if (useQueue && this.reloadLock) {
       this.log(`Reload currently in progress, adding ${getPluginDisplayName(name, version)} to queue`);
-      this.pluginReloadQueue.push({ name, version: version, loadType });
+      this.pluginReloadQueue.push({ name, version: version, loadType, hash });
       return;
     }
 
@@ -416,7 +509,7 @@ class PluginLoader extends Logger {
       this.unloadPlugin(name, true);
       const startTime = performance.now();
 
-      await this.importReactPlugin(name, version, loadType, timeoutMS);
+      await this.importReactPlugin(name, version, loadType, timeoutMS, hash);
       const endTime = performance.now();
 
       this.deckyState.setDisabledPlugins(this.deckyState.publicState().disabledPlugins.filter((d) => d.name !== name));
@@ -429,7 +522,7 @@ class PluginLoader extends Logger {
         this.reloadLock = false;
         const nextPlugin = this.pluginReloadQueue.shift();
         if (nextPlugin) {
-          this.importPlugin(nextPlugin.name, nextPlugin.version, nextPlugin.loadType, true, timeoutMS);
+          this.importPlugin(nextPlugin.name, nextPlugin.version, nextPlugin.loadType, true, timeoutMS, nextPlugin.hash);
         }
       }
     }
@@ -440,6 +533,7 @@ class PluginLoader extends Logger {
     version?: string,
     loadType: PluginLoadType = PluginLoadType.ESMODULE_V1,
     timeoutMS?: number,
+    hash?: string | null,
   ) {
     let spExists = this.checkForSP();
     const timeoutException = new Error(
@@ -450,7 +544,8 @@ class PluginLoader extends Logger {
     try {
       switch (loadType) {
         case PluginLoadType.ESMODULE_V1:
-          const importJS = () => import(`http://127.0.0.1:1337/plugins/${name}/dist/index.js?t=${Date.now()}`);
+          const url = this.getBundleURL(name, hash);
+          const importJS = () => import(url);
 
           const promise =
             timeoutMS === undefined
@@ -688,6 +783,10 @@ class PluginLoader extends Logger {
           console.warn(`Plugin ${pluginName} requested unsupported api version ${version}.`);
         }
 
+        // a reloaded plugin connects again, drop the subscriptions of its previous instance
+        for (const event of this.pluginEventListeners.get(pluginName)?.keys() ?? []) {
+          DeckyBackend.unsubscribe(`loader/plugin_event/${pluginName}/${event}`);
+        }
         const eventListeners: listenerMap = new Map();
         this.pluginEventListeners.set(pluginName, eventListeners);
 
@@ -698,9 +797,38 @@ class PluginLoader extends Logger {
           callable: (methodName: string) => {
             return (...args: any) => callPluginMethod(pluginName, methodName, ...args);
           },
+          callWithTimeout: (methodName: string, timeoutMS: number, ...args: any) => {
+            return DeckyBackend.callWithTimeout<[pluginName: string, method: string, ...args: any], any>(
+              'loader/call_plugin_method',
+              timeoutMS,
+              pluginName,
+              methodName,
+              ...args,
+            ).then(resolveSharedBlob);
+          },
+          stream: async function* (methodName: string, ...args: any) {
+            for await (const chunk of DeckyBackend.stream<[pluginName: string, method: string, ...args: any], any>(
+              'loader/call_plugin_method',
+              pluginName,
+              methodName,
+              ...args,
+            )) {
+              yield await resolveSharedBlob(chunk);
+            }
+          },
+          callWithOptions: (methodName: string, options: CallOptions, ...args: any) => {
+            return DeckyBackend.callWithOptions<[pluginName: string, method: string, ...args: any], any>(
+              'loader/call_plugin_method',
+              options,
+              pluginName,
+              methodName,
+              ...args,
+            ).then(resolveSharedBlob);
+          },
           addEventListener: (event: string, listener: (...args: any) => any) => {
             if (!eventListeners.has(event)) {
               eventListeners.set(event, new Set([listener]));
+              DeckyBackend.subscribe(`loader/plugin_event/${pluginName}/${event}`);
             } else {
               eventListeners.get(event)?.add(listener);
             }
@@ -710,6 +838,10 @@ class PluginLoader extends Logger {
             if (eventListeners.has(event)) {
               const set = eventListeners.get(event);
               set?.delete(listener);
+              if (set?.size === 0) {
+                eventListeners.delete(event);
+                DeckyBackend.unsubscribe(`loader/plugin_event/${pluginName}/${event}`);
+              }
             }
           },
           openFilePicker: this.openFilePicker.bind(this),
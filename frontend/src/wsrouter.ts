@@ -9,6 +9,7 @@ declare global {
 enum MessageType {
   ERROR = -1,
   // Call-reply, Frontend (CALL) -> Backend (REPLY|DISCARD) -> Frontend (RECEIVED_RESPONSE) -> Backend
+  // Streamed results are sent as REPLY messages with partial set, followed by a final REPLY with stream set
   CALL = 0,
   REPLY = 1,
   DISCARD = 2,
@@ -18,6 +19,16 @@ enum MessageType {
   FULL_SYNC = 4,
   // Pub/Sub, Backend -> Frontend
   EVENT = 5,
+  // Frontend (CANCEL) -> Backend, the frontend no longer waits for the call, no reply is sent
+  CANCEL = 6,
+  // Several calls in one message. Each reply is sent as soon as its call finishes, the BATCH_REPLY follows once
+  // all of them did and is the only one acknowledged. After a reconnect it carries every reply of the batch,
+  //   Frontend (BATCH) -> Backend (REPLY|ERROR|DISCARD..., BATCH_REPLY) -> Frontend (RECEIVED_RESPONSE) -> Backend
+  BATCH = 7,
+  BATCH_REPLY = 8,
+  // Frontend (SUBSCRIBE|UNSUBSCRIBE) -> Backend, once subscribed only the subscribed events are sent
+  SUBSCRIBE = 9,
+  UNSUBSCRIBE = 10,
 }
 
 interface CallMessage {
@@ -25,12 +36,18 @@ interface CallMessage {
   args: any[];
   route: string;
   id: number;
+  // milliseconds the backend may spend on the call before rejecting it with a TimeoutError
+  timeout?: number;
 }
 
 interface ReplyMessage {
   type: MessageType.REPLY;
   result: any;
   id: number;
+  // chunk of a streamed result
+  partial?: boolean;
+  // final reply of a streamed result
+  stream?: boolean;
 }
 
 interface DiscardMessage {
@@ -38,14 +55,45 @@ interface DiscardMessage {
   id: number;
 }
 
+// Acknowledges every reply up to up_to, plus the replies listed in ids
 interface ReceivedResponseMessage {
   type: MessageType.RECEIVED_RESPONSE;
+  up_to: number;
+  ids: number[];
+}
+
+interface CancelMessage {
+  type: MessageType.CANCEL;
+  id: number;
+}
+
+interface BatchMessage {
+  type: MessageType.BATCH;
+  id: number;
+  calls: CallMessage[];
+}
+
+interface BatchReplyMessage {
+  type: MessageType.BATCH_REPLY;
   id: number;
+  replies: (ReplyMessage | ErrorMessage | DiscardMessage)[];
+}
+
+interface SubscribeMessage {
+  type: MessageType.SUBSCRIBE;
+  events: string[];
+  // replaces the backend's subscriptions instead of adding to them
+  replace?: boolean;
+}
+
+interface UnsubscribeMessage {
+  type: MessageType.UNSUBSCRIBE;
+  events: string[];
 }
 
 interface FullSyncMessage {
   type: MessageType.FULL_SYNC;
-  messages: CallMessage[];
+  messages: (CallMessage | BatchMessage)[];
 }
 
 interface ErrorMessage {
@@ -78,20 +126,48 @@ interface EventMessage {
   args: any;
 }
 
-type MessageToBackend = CallMessage | ReceivedResponseMessage | FullSyncMessage;
-type MessageFromBackend = ReplyMessage | ErrorMessage | DiscardMessage | EventMessage;
+type MessageToBackend =
+  | CallMessage
+  | BatchMessage
+  | ReceivedResponseMessage
+  | FullSyncMessage
+  | CancelMessage
+  | SubscribeMessage
+  | UnsubscribeMessage;
+
+export interface CallOptions {
+  // milliseconds the backend may spend on the call before rejecting it with a TimeoutError
+  timeout?: number;
+  // aborting the signal rejects the call and stops it on the backend
+  signal?: AbortSignal;
+}
+type MessageFromBackend = ReplyMessage | ErrorMessage | DiscardMessage | EventMessage | BatchReplyMessage;
 
 // Helper to resolve a promise from the outside
 interface PromiseResolver<T> {
   resolve: (res: T) => void;
-  reject: (error: PyError) => void;
+  reject: (error: any) => void;
   promise: Promise<T>;
   message: CallMessage;
+  // receives the chunks of a streamed result, they are collected into an array and resolved with otherwise
+  onChunk?: (chunk: any) => void;
+  chunks?: any[];
+  // id of the batch the call was sent in
+  batchId?: number;
 }
 
 export class WSRouter extends Logger {
   runningCalls: Map<number, PromiseResolver<any>> = new Map();
+  runningBatches: Map<number, BatchMessage> = new Map();
+  // calls made in the current tick, they are sent together once it ends
+  queuedCalls: PromiseResolver<any>[] = [];
+  // replies received since the last acknowledgement was sent
+  receivedResponses: number[] = [];
+  ackTimeout?: number;
   eventListeners: Map<string, Set<(...args: any) => any>> = new Map();
+  // number of subscribers per topic, and the changes not sent to the backend yet
+  subscriptions: Map<string, number> = new Map();
+  subscriptionChanges: Map<string, boolean> = new Map();
   ws?: WebSocket;
   // Used to map results and errors to calls
   reqId: number = 0;
@@ -108,9 +184,22 @@ export class WSRouter extends Logger {
         this.debug('WS Connected');
         resolve();
 
+        // The backend starts out sending every event, tell it which ones we listen to
+        this.subscriptionChanges.clear();
+        this.write({ type: MessageType.SUBSCRIBE, events: Array.from(this.subscriptions.keys()), replace: true });
+
         // Synchronize frontend and backend by forwarding all the running calls again
         // and letting backend reply to them accordingly.
-        const messages = Array.from(this.runningCalls.values()).map((resolver) => resolver.message);
+        // Calls of a batch that already got their reply are left out, a backend that lost its state would run them again.
+        const messages: (CallMessage | BatchMessage)[] = Array.from(this.runningBatches.values(), (batch) => ({
+          ...batch,
+          calls: batch.calls.filter((call) => this.runningCalls.has(call.id)),
+        }));
+        for (const resolver of this.runningCalls.values()) {
+          if (resolver.batchId === undefined || !this.runningBatches.has(resolver.batchId)) {
+            messages.push(resolver.message);
+          }
+        }
         this.write({ type: MessageType.FULL_SYNC, messages });
       });
       this.ws.addEventListener('message', this.onMessage.bind(this));
@@ -131,6 +220,7 @@ export class WSRouter extends Logger {
   addEventListener(event: string, listener: (...args: any) => any) {
     if (!this.eventListeners.has(event)) {
       this.eventListeners.set(event, new Set([listener]));
+      this.subscribe(event);
     } else {
       this.eventListeners.get(event)?.add(listener);
     }
@@ -143,22 +233,87 @@ export class WSRouter extends Logger {
       set?.delete(listener);
       if (set?.size === 0) {
         this.eventListeners.delete(event);
+        this.unsubscribe(event);
       }
     }
   }
 
+  // Asks the backend to send a topic, topics are usually event names.
+  // Changes made within the same tick are sent together.
+  subscribe(topic: string) {
+    const count = this.subscriptions.get(topic) ?? 0;
+    this.subscriptions.set(topic, count + 1);
+    if (count === 0) this.changeSubscription(topic, true);
+  }
+
+  unsubscribe(topic: string) {
+    const count = this.subscriptions.get(topic);
+    if (count === undefined) return;
+    if (count > 1) {
+      this.subscriptions.set(topic, count - 1);
+    } else {
+      this.subscriptions.delete(topic);
+      this.changeSubscription(topic, false);
+    }
+  }
+
+  private changeSubscription(topic: string, subscribed: boolean) {
+    if (this.subscriptionChanges.size === 0) queueMicrotask(() => this.flushSubscriptions());
+    this.subscriptionChanges.set(topic, subscribed);
+  }
+
+  private flushSubscriptions() {
+    const changes = Array.from(this.subscriptionChanges.entries());
+    this.subscriptionChanges.clear();
+    const subscribed = changes.filter(([, subscribed]) => subscribed).map(([topic]) => topic);
+    const unsubscribed = changes.filter(([, subscribed]) => !subscribed).map(([topic]) => topic);
+    if (subscribed.length > 0) this.write({ type: MessageType.SUBSCRIBE, events: subscribed });
+    if (unsubscribed.length > 0) this.write({ type: MessageType.UNSUBSCRIBE, events: unsubscribed });
+  }
+
   async onMessage(msg: MessageEvent) {
     try {
-      const data = JSON.parse(msg.data) as MessageFromBackend;
+      const parsed = JSON.parse(msg.data) as MessageFromBackend | MessageFromBackend[];
+      // the backend sends messages queued at the same time as one array
+      for (const data of Array.isArray(parsed) ? parsed : [parsed]) {
+        if (data.type === MessageType.BATCH_REPLY) {
+          this.runningBatches.delete(data.id);
+          for (const reply of data.replies) {
+            this.handleMessage(reply, false);
+          }
+          // the whole batch is acknowledged at once
+          this.acknowledge(data.id);
+        } else {
+          // replies to batched calls are acknowledged with their batch
+          const batched = 'id' in data && this.runningCalls.get(data.id)?.batchId !== undefined;
+          this.handleMessage(data, !batched);
+        }
+      }
+    } catch (e) {
+      this.error('Error parsing WebSocket message', e);
+    }
+  }
+
+  private handleMessage(data: Exclude<MessageFromBackend, BatchReplyMessage>, ack: boolean) {
+    try {
       switch (data.type) {
         case MessageType.REPLY:
+          if (data.partial) {
+            const resolver = this.runningCalls.get(data.id);
+            if (resolver?.onChunk) resolver.onChunk(data.result);
+            else if (resolver) (resolver.chunks ??= []).push(data.result);
+            // only the final reply is acknowledged
+            break;
+          }
+
           if (this.runningCalls.has(data.id)) {
-            this.runningCalls.get(data.id)!.resolve(data.result);
+            const resolver = this.runningCalls.get(data.id)!;
+            resolver.resolve(data.stream ? resolver.chunks ?? [] : data.result);
             this.runningCalls.delete(data.id);
             this.debug(`[${data.id}] Resolved PY call with value`, data.result);
           }
 
-          this.write({ type: MessageType.RECEIVED_RESPONSE, id: data.id });
+          if (ack) this.acknowledge(data.id);
           break;
 
         case MessageType.ERROR:
@@ -169,7 +324,7 @@ export class WSRouter extends Logger {
             this.debug(`[${data.id}] Rejected PY call with error`, data.error);
           }
 
-          this.write({ type: MessageType.RECEIVED_RESPONSE, id: data.id });
+          if (ack) this.acknowledge(data.id);
           break;
 
         case MessageType.DISCARD:
@@ -182,7 +337,7 @@ export class WSRouter extends Logger {
             this.debug(`[${data.id}] Discarding PY call`);
           }
 
-          this.write({ type: MessageType.RECEIVED_RESPONSE, id: data.id });
+          if (ack) this.acknowledge(data.id);
           break;
 
         case MessageType.EVENT:
@@ -207,22 +362,140 @@ export class WSRouter extends Logger {
           break;
       }
     } catch (e) {
-      this.error('Error parsing WebSocket message', e);
+      this.error('Error handling WebSocket message', e);
     }
   }
 
   // this.call<[number, number], string>('methodName', 1, 2);
   call<Args extends any[] = [], Return = void>(route: string, ...args: Args): Promise<Return> {
+    return this.callRoute<Args, Return>(route, args);
+  }
+
+  // this.callWithTimeout<[number, number], string>('methodName', 5000, 1, 2);
+  callWithTimeout<Args extends any[] = [], Return = void>(
+    route: string,
+    timeoutMS: number,
+    ...args: Args
+  ): Promise<Return> {
+    return this.callRoute<Args, Return>(route, args, { timeout: timeoutMS });
+  }
+
+  // this.callWithOptions<[number, number], string>('methodName', { signal: controller.signal }, 1, 2);
+  callWithOptions<Args extends any[] = [], Return = void>(
+    route: string,
+    options: CallOptions,
+    ...args: Args
+  ): Promise<Return> {
+    return this.callRoute<Args, Return>(route, args, options);
+  }
+
+  // Iterates over the chunks of a route returning an async generator, breaking out of the loop cancels the call.
+  // for await (const chunk of this.stream<[string], string>('methodName', 'arg')) {}
+  async *stream<Args extends any[] = [], Chunk = any>(route: string, ...args: Args): AsyncGenerator<Chunk, void> {
+    const controller = new AbortController();
+    const chunks: Chunk[] = [];
+    let done = false;
+    let wake: (() => void) | undefined;
+
+    const promise = this.callRoute<Args, void>(route, args, { signal: controller.signal }, (chunk) => {
+      chunks.push(chunk);
+      wake?.();
+    });
+    const finish = () => {
+      done = true;
+      wake?.();
+    };
+    promise.then(finish, finish);
+
+    try {
+      while (true) {
+        if (chunks.length > 0) {
+          yield chunks.shift()!;
+        } else if (done) {
+          // rethrows the error if the call failed
+          await promise;
+          return;
+        } else {
+          await new Promise<void>((resolve) => (wake = resolve));
+        }
+      }
+    } finally {
+      // no-op if the call already finished
+      controller.abort();
+    }
+  }
+
+  private callRoute<Args extends any[], Return>(
+    route: string,
+    args: Args,
+    { timeout, signal }: CallOptions = {},
+    onChunk?: (chunk: any) => void,
+  ): Promise<Return> {
+    if (signal?.aborted) return Promise.reject(signal.reason);
+
     const id = ++this.reqId;
-    const resolver = this.createPromiseResolver<Return>({ type: MessageType.CALL, route, args, id });
+    const message: CallMessage = { type: MessageType.CALL, route, args, id };
+    if (timeout !== undefined) message.timeout = timeout;
+    const resolver = this.createPromiseResolver<Return>(message);
+    resolver.onChunk = onChunk;
     this.runningCalls.set(id, resolver);
 
+    signal?.addEventListener(
+      'abort',
+      () => {
+        if (!this.runningCalls.has(id)) return;
+        this.runningCalls.delete(id);
+        this.debug(`[${id}] Cancelling PY call`);
+        // calls still waiting for the end of the tick have not reached the backend yet
+        if (!this.queuedCalls.includes(resolver)) this.write({ type: MessageType.CANCEL, id });
+        resolver.reject(signal.reason);
+      },
+      { once: true },
+    );
+
     this.debug(`[${id}] Calling PY method ${route} with args`, args);
-    this.write(resolver.message);
+    if (this.queuedCalls.push(resolver) === 1) queueMicrotask(() => this.flushCalls());
 
     return resolver.promise;
   }
 
+  // Acknowledgements are sent together shortly after the replies arrive
+  private acknowledge(id: number) {
+    this.receivedResponses.push(id);
+    this.ackTimeout ??= window.setTimeout(() => this.flushAcknowledgements(), 50);
+  }
+
+  private flushAcknowledgements() {
+    this.ackTimeout = undefined;
+    // every call older than the oldest one still running has its reply by now
+    let upTo = this.reqId;
+    for (const id of [...this.runningCalls.keys(), ...this.runningBatches.keys()]) {
+      upTo = Math.min(upTo, id - 1);
+    }
+    const ids = this.receivedResponses.filter((id) => id > upTo);
+    this.receivedResponses = [];
+    this.write({ type: MessageType.RECEIVED_RESPONSE, up_to: upTo, ids });
+  }
+
+  private flushCalls() {
+    // calls aborted before the end of the tick are never sent
+    const resolvers = this.queuedCalls.filter((resolver) => this.runningCalls.has(resolver.message.id));
+    this.queuedCalls = [];
+    if (resolvers.length === 1) {
+      this.write(resolvers[0].message);
+    } else if (resolvers.length > 1) {
+      const batch: BatchMessage = {
+        type: MessageType.BATCH,
+        id: ++this.reqId,
+        calls: resolvers.map((resolver) => resolver.message),
+      };
+      for (const resolver of resolvers) resolver.batchId = batch.id;
+      this.runningBatches.set(batch.id, batch);
+      this.debug(`[${batch.id}] Sending batch of ${resolvers.length} PY calls`);
+      this.write(batch);
+    }
+  }
+
   callable<Args extends any[] = [], Return = void>(route: string): (...args: Args) => Promise<Return> {
     return (...args) => this.call<Args, Return>(route, ...args);
   }